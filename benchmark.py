@@ -1,76 +1,252 @@
+import argparse
+import json
 import multiprocessing
-import queue
+import platform
+import timeit
 
 import numpy as np
 import scipy
-from PIL import Image
-import PIL
-import timeit
-import matplotlib.pyplot as plt
-import json
-from multiprocessing import Process
 
-import lens
-import ray
 import renderer
 import emitter
-import ior
 import raytracer
 import lensassembly
+import kernels
+import optimizer
+import trace3d
 
-def RayTrace(lights, assembly):
-    rays = np.array([])
-    # Rays that go through the final glass element
-    finalrays = np.array([])
-    lenses = assembly.lenses
-    for light in lights:
-        rays = np.append(rays,light.rays)
-        airIOR = ior.AirRefractiveIndex(light.microns)
-        for r in light.rays:
-            # rays.append(r)
-            incidentray = r
-            for i in range(len(lenses)):
-                l = lenses[i]
-                refracted = raytracer.GenerateRefractedRay(incidentray, l, airIOR, l.GetIOR(light.microns))
-                rays = np.append(rays, refracted)
-                if len(refracted) < 2:
-                    break
-                if i == len(lenses) - 1:
-                    finalrays = np.append(finalrays,refracted[1])
-                incidentray = refracted[1]
-
-    return rays, finalrays
+# Benchmark suite
+# Every case is built for a ray count and returns the function to time and its amount of work in the unit of
+# UNITS, ray surfaces (rays times the surfaces they are tested against) for the trace cases and plain rays or
+# segments for the cases that handle every ray once
+# Throughput is reported as work per second, and as a multiple of a fixed NumPy calibration workload
+# so results from different machines can be compared
+# e.g. python benchmark.py --rays 1000 10000 100000 --save baseline.json
+#      python benchmark.py --compare baseline.json --threshold 0.15
 
+WAVELENGTH_R = 0.700  # 700nm
+WAVELENGTH_V = 0.400  # 400nm
+PLANE_WIDTH = 18
 
-if __name__ == '__main__':
-    WAVELENGTH_R = 0.700  # 700nm
-    WAVELENGTH_V = 0.400  # 400nm
-    FLANGE_DISTANCE = 18    # 18mm for Sony E mount
-    SENSOR_HEIGHT = 25.1    # Width of Sony APS-C Sensor
+# Lens stacks of the trace cases, as (part, offset, dir)
+ASSEMBLIES = {
+    1: [("AL2550", 0, "left")],
+    3: [("LA1805", 0, "left"), ("LD2297", 5.4, "left"), ("LA1805", 5.4, "right")],
+    10: [("LA1805", 0, "left"), ("LD2297", 5.4, "left"), ("LA1805", 5.4, "right"),
+         ("LA1509", 10, "left"), ("LD1464", 5, "left"), ("LA1509", 5, "right"),
+         ("LA1805", 10, "left"), ("LD2297", 5.4, "left"), ("LA1805", 5.4, "right"),
+         ("LA1509", 10, "left")],
+}
+
+def LoadCatalog(path="Thorlabs.json"):
+    with open(path) as f:
+        return json.load(f)
+
+def BuildAssembly(lib, numLenses):
+    assembly = lensassembly.LensAssembly([0, 0], lib)
+    for part, offset, dir in ASSEMBLIES[numLenses]:
+        assembly.AddLens(part, offset, dir)
+    return assembly
+
+# Two wavelength plane source with rays split evenly between the emitters
+def Lights(rays):
+    return [emitter.Emitter([-1000, 0], rays // 2, 0, PLANE_WIDTH, microns=WAVELENGTH_R, type="plane"),
+            emitter.Emitter([-1000, 0], rays - rays // 2, 0, PLANE_WIDTH, microns=WAVELENGTH_V, type="plane")]
+
+def EmitterCase(lib, rays):
+    light = emitter.Emitter([-1000, 0], rays, 0, PLANE_WIDTH, type="plane", sampling="random", seed=0)
+    return light.GenRays, rays
+
+def IntersectCase(lib, rays):
+    l = BuildAssembly(lib, 1).lenses[0]
+    b = emitter.Emitter([-1000, 0], rays, 0, l.config["diameter"], type="plane").rays
+    surface = l.frontSurface
+    return lambda: raytracer.IntersectSurface(b.x, b.y, b.dx, b.dy, surface), rays
+
+def TraceCase(numLenses):
+    def Build(lib, rays):
+        assembly = BuildAssembly(lib, numLenses)
+        lights = Lights(rays)
+        for light in lights:
+            light.rays
+        return lambda: raytracer.RayTrace(lights, assembly, keepSegments=False), rays * assembly.numSurfaces
+    return Build
+
+# Skew rays from a random pupil through the three lens stack
+def Trace3DCase(lib, rays):
+    assembly = BuildAssembly(lib, 3)
+    light = emitter.Emitter3D([-1000, 0], rays, 0, PLANE_WIDTH, microns=WAVELENGTH_R, pattern="random", seed=0)
+    light.rays
+    return lambda: trace3d.RayTrace3D([light], assembly, keepSegments=False), rays * assembly.numSurfaces
 
-    f = open("Thorlabs.json")
-    lib = json.load(f)
+def HitsCase(lib, rays):
+    assembly = BuildAssembly(lib, 3)
+    finalrays = raytracer.RayTrace(Lights(rays), assembly, keepSegments=False).finalrays
+    return lambda: optimizer.CalculateHits(finalrays, assembly), rays
 
-    lens3 = lensassembly.LensAssembly([0,0],lib, sensorOffset=FLANGE_DISTANCE, sensorHeight=SENSOR_HEIGHT)
-    lens3.AddLens("AL2550")
+def RenderCase(lib, rays):
+    assembly = BuildAssembly(lib, 3)
+    segments = raytracer.RayTrace(Lights(rays), assembly).rays
+    def Draw():
+        im = renderer.Renderer(2000, 1000, scale=10)
+        im.DrawRays(segments)
+    return Draw, len(segments)
 
-    RAYS = 10000
-    PLANE_WIDTH = 18
-    lights = []
-    lights.append(emitter.Emitter([-1000, 0],RAYS,0,PLANE_WIDTH, microns=WAVELENGTH_R,type="plane"))
-    lights.append(emitter.Emitter([-1000, 0], RAYS, 0, PLANE_WIDTH, microns=WAVELENGTH_V, type="plane"))
+def OptimizerCase(lib, rays):
+    assembly = BuildAssembly(lib, 3)
+    objective = optimizer.OffsetObjective(assembly, [Lights(rays)], [1, 1], incremental=False)
+    offsets = np.array([5.4, 5.4])
+    return lambda: objective(offsets), rays * assembly.numSurfaces
 
-    def benchmark(iter=100):
-        elapsed = []
-        for i in range(iter):
-            startTime = timeit.default_timer()
-            RayTrace(lights, lens3)
-            elapsed.append(timeit.default_timer() - startTime)
-            print("iter: {} elapsed: {}".format(i, elapsed[-1]))
-        return sum(elapsed) / len(elapsed)
+CASES = {
+    "emitter": EmitterCase,
+    "intersect": IntersectCase,
+    "trace1": TraceCase(1),
+    "trace3": TraceCase(3),
+    "trace10": TraceCase(10),
+    "trace3d": Trace3DCase,
+    "hits": HitsCase,
+    "render": RenderCase,
+    "optimizer": OptimizerCase,
+}
+
+# Unit of the work returned by every case
+UNITS = {
+    "emitter": "rays",
+    "intersect": "rays",
+    "trace1": "ray surfaces",
+    "trace3": "ray surfaces",
+    "trace10": "ray surfaces",
+    "trace3d": "ray surfaces",
+    "hits": "rays",
+    "render": "segments",
+    "optimizer": "ray surfaces",
+}
+
+# Elapsed time of every call after warmup untimed calls, the first call compiles the numba kernels
+def Measure(func, repeat=5, warmup=1):
+    for i in range(warmup):
+        func()
+    elapsed = []
+    for i in range(repeat):
+        startTime = timeit.default_timer()
+        func()
+        elapsed.append(timeit.default_timer() - startTime)
+    return np.array(elapsed)
+
+# Elements per second of a fixed vectorized workload, the unit of the normalized throughput
+def Calibrate(repeat=5):
+    x = np.linspace(-1, 1, 1000000)
+    elapsed = Measure(lambda: np.sqrt(1 - 0.5 * x * x) + np.sin(x) * np.cos(x), repeat)
+    return len(x) / np.median(elapsed)
+
+def MachineInfo():
+    return {"platform": platform.platform(),
+            "processor": platform.processor() or platform.machine(),
+            "cpus": multiprocessing.cpu_count(),
+            "python": platform.python_version(),
+            "numpy": np.__version__,
+            "scipy": scipy.__version__,
+            "numba": None if kernels.numba is None else kernels.numba.__version__,
+            "backend": "numba" if kernels.UseNumba() else "numpy"}
+
+# Runs every case at every ray count, returns the report saved as a JSON baseline
+def RunSuite(cases=None, rayCounts=(1000, 10000, 100000), repeat=5, lib=None, verbose=True):
+    lib = lib or LoadCatalog()
+    cases = cases or list(CASES)
+    report = {"machine": MachineInfo(), "calibration": Calibrate(), "results": []}
+    for name in cases:
+        for rays in rayCounts:
+            func, work = CASES[name](lib, rays)
+            elapsed = Measure(func, repeat)
+            throughput = work / elapsed
+            result = {"case": name, "rays": rays, "work": work, "unit": UNITS[name],
+                      "mean": float(elapsed.mean()), "std": float(elapsed.std()), "min": float(elapsed.min()),
+                      "throughput": float(np.median(throughput)), "throughputStd": float(throughput.std()),
+                      "normalized": float(np.median(throughput) / report["calibration"])}
+            report["results"].append(result)
+            if verbose:
+                print("{:<10} rays: {:>8} mean: {:.6f}s std: {:.6f}s {}/s: {:.3e} +- {:.1e} normalized: {:.4f}".format(
+                    name, rays, result["mean"], result["std"], result["unit"], result["throughput"],
+                    result["throughputStd"], result["normalized"]))
+    return report
+
+def SaveBaseline(report, path):
+    with open(path, "w") as f:
+        json.dump(report, f, indent=2)
+
+def LoadBaseline(path):
+    with open(path) as f:
+        return json.load(f)
+
+# Cases whose throughput dropped by more than threshold (a fraction) compared to the baseline
+# Normalized throughput is compared when the baseline comes from another machine or backend
+# Returns a list of (case, rays, baseline, current, change)
+def Compare(report, baseline, threshold=0.1):
+    sameMachine = report["machine"] == baseline["machine"]
+    key = "throughput" if sameMachine else "normalized"
+    previous = {(r["case"], r["rays"]): r for r in baseline["results"]}
+    regressions = []
+    for r in report["results"]:
+        old = previous.get((r["case"], r["rays"]))
+        if old is None:
+            continue
+        change = r[key] / old[key] - 1
+        if change < -threshold:
+            regressions.append((r["case"], r["rays"], old[key], r[key], change))
+    return regressions
+
+# Compares the sag, slope and intersection kernels of every available backend on one lens
+def BenchmarkKernels(l, rays=100000, iter=10):
+    radius = l.config["diameter"] / 2
+    t = np.linspace(-radius, radius, rays)
+    b = emitter.Emitter([-1000, 0], rays, 0, 2 * radius, type="plane").rays
+    surface = l.frontSurface
+    backends = ["numpy"]
+    if kernels.numba is not None:
+        backends.append("numba")
+    previous = kernels.GetBackend()
+    results = {}
+    for backend in backends:
+        kernels.SetBackend(backend)
+        cases = {"sag": lambda: l.FrontSag(t),
+                 "slope": lambda: l.FrontSlope(t),
+                 "intersect": lambda: raytracer.IntersectSurface(b.x, b.y, b.dx, b.dy, surface)}
+        for name, func in cases.items():
+            best = Measure(func, iter).min()
+            results[(backend, name)] = best
+            print("backend: {} kernel: {} best: {:.6f}s rays/s: {:.3e}".format(backend, name, best, rays / best))
+    kernels.SetBackend(previous)
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Ray tracer benchmark suite")
+    parser.add_argument("--cases", nargs="+", choices=list(CASES), default=list(CASES))
+    parser.add_argument("--rays", nargs="+", type=int, default=[1000, 10000, 100000])
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--backend", choices=kernels.BACKENDS + ["auto"], default="auto")
+    parser.add_argument("--catalog", default="Thorlabs.json")
+    parser.add_argument("--save", help="write the results as a JSON baseline")
+    parser.add_argument("--compare", help="baseline JSON to check for regressions")
+    parser.add_argument("--threshold", type=float, default=0.1, help="allowed throughput drop as a fraction")
+    parser.add_argument("--kernels", action="store_true", help="also compare the sag, slope and intersection kernels")
+    args = parser.parse_args()
 
+    kernels.SetBackend(args.backend)
+    lib = LoadCatalog(args.catalog)
+    report = RunSuite(args.cases, args.rays, args.repeat, lib)
+    print(json.dumps(report["machine"]))
 
-    avg_time = benchmark(10)
-    print("average time: {}".format(avg_time))
+    if args.kernels:
+        BenchmarkKernels(BuildAssembly(lib, 1).lenses[0])
 
+    if args.save:
+        SaveBaseline(report, args.save)
 
+    if args.compare:
+        regressions = Compare(report, LoadBaseline(args.compare), args.threshold)
+        for case, rays, old, new, change in regressions:
+            print("regression: {} rays: {} {:.3e} -> {:.3e} ({:+.1%})".format(case, rays, old, new, change))
+        if regressions:
+            raise SystemExit(1)
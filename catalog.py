@@ -0,0 +1,259 @@
+import json
+import os
+
+import numpy as np
+
+# Compiled lens catalogs
+# A JSON catalog like Thorlabs.json is compiled once into a directory of .npy files that are memory mapped on load:
+#   records.npy     structured array with one row per part, sorted by part number
+#   strings.npy     uint8 blob holding every alias, description and unknown key as UTF-8
+#   focal.npy       row indices sorted by focal length
+#   focalvalues.npy focal lengths in the order of focal.npy
+#   groups.npy      row indices sorted by material, type and focal length
+#   groupfocal.npy  focal lengths in the order of groups.npy
+#   groupstart.npy  start of every (material, type) group in groups.npy
+#   meta.json       format version, material and type names
+# Lookups and queries only touch the pages they need, so catalogs with many parts open instantly
+
+VERSION = 2
+
+# Known lens config keys, in the order of the presence bits
+NUMBERS = ["diameter", "radius", "conic", "radius2", "conic2", "thickness", "focalLength"]
+COEFFS = ["coeff", "coeff2"]
+STRINGS = ["alias", "description"]
+KEYS = NUMBERS + COEFFS + STRINGS + ["material", "type"]
+
+def _RecordDtype(partWidth, coeffWidth):
+    fields = [("part", "S{}".format(max(partWidth, 1))), ("present", np.uint16)]
+    fields += [(name, np.float64) for name in NUMBERS]
+    for name in COEFFS:
+        fields += [(name, np.float64, (max(coeffWidth, 1),)), ("n" + name, np.uint8)]
+    # Strings are (offset, length) into the string table
+    for name in STRINGS + ["extra"]:
+        fields += [(name, np.uint32, (2,))]
+    fields += [("material", np.int16), ("type", np.int16)]
+    return np.dtype(fields)
+
+# Compiles a catalog dictionary or JSON file into the directory path, returns the opened Catalog
+def Compile(source, path):
+    if not isinstance(source, dict):
+        with open(source) as f:
+            source = json.load(f)
+
+    parts = sorted(source)
+    materials = sorted({str(source[p].get("material", "")) for p in parts})
+    types = sorted({str(source[p].get("type", "")) for p in parts})
+    partWidth = max([len(p.encode()) for p in parts], default=1)
+    coeffWidth = max([len(source[p].get(name) or []) for p in parts for name in COEFFS], default=1)
+
+    records = np.zeros(len(parts), dtype=_RecordDtype(partWidth, coeffWidth))
+    blob = bytearray()
+
+    def AddString(text):
+        data = text.encode()
+        offset = len(blob)
+        blob.extend(data)
+        return (offset, len(data))
+
+    for row, part in enumerate(parts):
+        config = source[part]
+        rec = records[row]
+        rec["part"] = part.encode()
+        present = 0
+        for bit, name in enumerate(KEYS):
+            if name in config and config[name] is not None:
+                present |= 1 << bit
+        rec["present"] = present
+        for name in NUMBERS:
+            value = config.get(name)
+            rec[name] = np.nan if value is None else value
+        for name in COEFFS:
+            coeff = config.get(name) or []
+            rec[name][:len(coeff)] = coeff
+            rec["n" + name] = len(coeff)
+        for name in STRINGS:
+            rec[name] = AddString(str(config.get(name, "")))
+        extra = {k: v for k, v in config.items() if k not in KEYS}
+        rec["extra"] = AddString(json.dumps(extra) if extra else "")
+        rec["material"] = materials.index(str(config.get("material", "")))
+        rec["type"] = types.index(str(config.get("type", "")))
+
+    # Composite index, every material is contiguous and split into its types, each sorted by focal length
+    group = records["material"].astype(np.int64) * len(types) + records["type"]
+    groups = np.lexsort((records["focalLength"], group)).astype(np.int32)
+    groupStart = np.searchsorted(group[groups], np.arange(len(materials) * len(types) + 1)).astype(np.int64)
+
+    os.makedirs(path, exist_ok=True)
+    np.save(os.path.join(path, "records.npy"), records)
+    np.save(os.path.join(path, "strings.npy"), np.frombuffer(bytes(blob), dtype=np.uint8))
+    focal = np.argsort(records["focalLength"], kind="stable").astype(np.int32)
+    np.save(os.path.join(path, "focal.npy"), focal)
+    # Sorted focal lengths next to the indices, range queries bisect them without touching the records
+    np.save(os.path.join(path, "focalvalues.npy"), records["focalLength"][focal])
+    np.save(os.path.join(path, "groups.npy"), groups)
+    np.save(os.path.join(path, "groupfocal.npy"), records["focalLength"][groups])
+    np.save(os.path.join(path, "groupstart.npy"), groupStart)
+    with open(os.path.join(path, "meta.json"), "w") as f:
+        json.dump({"version": VERSION, "materials": materials, "types": types}, f)
+    return Catalog(path)
+
+# Read only view of a compiled catalog
+# Behaves like the parsed JSON dictionary, so it can be passed to lensassembly.LensAssembly directly
+class Catalog:
+    def __init__(self, path):
+        with open(os.path.join(path, "meta.json")) as f:
+            meta = json.load(f)
+        if meta["version"] != VERSION:
+            raise Exception("catalog {} has version {}, expected {}".format(path, meta["version"], VERSION))
+        self._path = path
+        self._materials = meta["materials"]
+        self._types = meta["types"]
+        self._records = self._Load("records.npy")
+        self._strings = self._Load("strings.npy")
+        self._focal = self._Load("focal.npy")
+        self._focalValues = self._Load("focalvalues.npy")
+        self._groups = self._Load("groups.npy")
+        self._groupFocal = self._Load("groupfocal.npy")
+        self._groupStart = self._Load("groupstart.npy")
+
+    # Only the path is pickled, worker processes map the files again
+    def __getstate__(self):
+        return {"path": self._path}
+
+    def __setstate__(self, state):
+        self.__init__(state["path"])
+
+    def _Load(self, name):
+        return np.load(os.path.join(self._path, name), mmap_mode="r")
+
+    def _String(self, span):
+        offset, length = int(span[0]), int(span[1])
+        return bytes(self._strings[offset:offset + length]).decode()
+
+    # Row of a part number, or -1 when the catalog has no such part
+    def Find(self, part):
+        key = part.encode()
+        parts = self._records["part"]
+        row = int(np.searchsorted(parts, key))
+        if row < len(parts) and parts[row] == key:
+            return row
+        return -1
+
+    # Rebuilds the lens config dictionary of a row
+    def Config(self, row):
+        rec = self._records[row]
+        present = int(rec["present"])
+        config = {}
+        for bit, name in enumerate(KEYS):
+            if not present & (1 << bit):
+                continue
+            if name in NUMBERS:
+                value = float(rec[name])
+                config[name] = int(value) if value.is_integer() else value
+            elif name in COEFFS:
+                config[name] = [float(c) for c in rec[name][:rec["n" + name]]]
+            elif name in STRINGS:
+                config[name] = self._String(rec[name])
+            elif name == "material":
+                config[name] = self._materials[rec["material"]]
+            else:
+                config[name] = self._types[rec["type"]]
+        extra = self._String(rec["extra"])
+        if extra:
+            config.update(json.loads(extra))
+        return config
+
+    def __getitem__(self, part):
+        row = self.Find(part)
+        if row < 0:
+            raise KeyError(part)
+        return self.Config(row)
+
+    def __contains__(self, part):
+        return self.Find(part) >= 0
+
+    def __len__(self):
+        return len(self._records)
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def keys(self):
+        return [p.decode() for p in self._records["part"]]
+
+    def get(self, part, default=None):
+        row = self.Find(part)
+        return default if row < 0 else self.Config(row)
+
+    # Rows matching every given filter, sorted by focal length
+    # focalLength is a (low, high) range matched as low < f < high, either bound may be None
+    def QueryRows(self, material=None, type=None, focalLength=None):
+        if material is None and type is None:
+            rows = self._focal
+            if focalLength is not None:
+                rows = rows[self._FocalSlice(self._focalValues, focalLength)]
+            return np.asarray(rows)
+
+        materials = range(len(self._materials)) if material is None else [self._Code(self._materials, material)]
+        types = range(len(self._types)) if type is None else [self._Code(self._types, type)]
+        chunks = []
+        focal = []
+        for m in materials:
+            for t in types:
+                if m < 0 or t < 0:
+                    continue
+                g = m * len(self._types) + t
+                span = slice(self._groupStart[g], self._groupStart[g + 1])
+                if focalLength is not None:
+                    inner = self._FocalSlice(self._groupFocal[span], focalLength)
+                    span = slice(span.start + inner.start, span.start + inner.stop)
+                chunks.append(np.asarray(self._groups[span]))
+                focal.append(np.asarray(self._groupFocal[span]))
+        if len(chunks) == 0:
+            return np.zeros(0, dtype=np.int32)
+        rows = np.concatenate(chunks)
+        return rows[np.argsort(np.concatenate(focal), kind="stable")]
+
+    # Part numbers matching every given filter, e.g. Query("BK7", "planoconvex", (20, 40))
+    def Query(self, material=None, type=None, focalLength=None):
+        rows = self.QueryRows(material, type, focalLength)
+        return [p.decode() for p in self._records["part"][rows]]
+
+    @staticmethod
+    def _Code(names, name):
+        return names.index(name) if name in names else -1
+
+    # Slice of a sorted focal length array inside the open range
+    @staticmethod
+    def _FocalSlice(focal, focalRange):
+        low, high = focalRange
+        start = 0 if low is None else np.searchsorted(focal, low, side="right")
+        stop = len(focal) if high is None else np.searchsorted(focal, high, side="left")
+        return slice(start, max(start, stop))
+
+    # Memory mapped records, for vectorized access to the numeric fields
+    @property
+    def records(self):
+        return self._records
+
+    @property
+    def materials(self):
+        return list(self._materials)
+
+    @property
+    def types(self):
+        return list(self._types)
+
+# Opens a compiled catalog, a JSON catalog is compiled next to it first when it has no compiled copy or is newer
+def Open(path):
+    if not path.endswith(".json"):
+        return Catalog(path)
+    compiled = path[:-len(".json")] + ".catalog"
+    meta = os.path.join(compiled, "meta.json")
+    if not os.path.exists(meta) or os.path.getmtime(meta) < os.path.getmtime(path):
+        return Compile(path, compiled)
+    # Catalogs compiled by an older version are rebuilt
+    with open(meta) as f:
+        if json.load(f).get("version") != VERSION:
+            return Compile(path, compiled)
+    return Catalog(compiled)
@@ -1,64 +1,327 @@
+import functools
+
 import ray
 import numpy as np
 
+# Emission spectrum of an Emitter
+# Discrete lines at microns with relative weights, or with continuous=True a density tabulated at microns
+# Sample maps values in [0, 1) to wavelengths through the inverse cumulative distribution
+class Spectrum:
+    def __init__(self, microns, weights=None, continuous=False):
+        self._microns = np.asarray(microns, dtype=float)
+        if weights is None:
+            weights = np.ones(len(self._microns))
+        self._weights = np.asarray(weights, dtype=float)
+        self._continuous = continuous
+        if len(self._microns) != len(self._weights) or len(self._microns) == 0:
+            raise Exception("spectrum needs one weight per wavelength")
+        if continuous:
+            order = np.argsort(self._microns)
+            self._microns = self._microns[order]
+            self._weights = self._weights[order]
+            # Trapezoid area of every interval, the density is linear in between samples
+            area = (self._weights[1:] + self._weights[:-1]) / 2 * np.diff(self._microns)
+            self._cdf = np.concatenate([[0], np.cumsum(area)])
+        else:
+            self._cdf = np.concatenate([[0], np.cumsum(self._weights)])
+        self._cdf /= self._cdf[-1]
+
+    # Samples a continuous density function func(microns) on samples points between low and high
+    @classmethod
+    def FromFunction(cls, func, low, high, samples=256):
+        microns = np.linspace(low, high, samples)
+        return cls(microns, func(microns), continuous=True)
+
+    def Sample(self, u):
+        u = np.asarray(u, dtype=float)
+        if self._continuous:
+            return np.interp(u, self._cdf, self._microns)
+        idx = np.searchsorted(self._cdf, u, side="right") - 1
+        return self._microns[np.clip(idx, 0, len(self._microns) - 1)]
+
+    @property
+    def key(self):
+        return (tuple(self._microns.tolist()), tuple(self._weights.tolist()), self._continuous)
+
+    # Wavelengths of the lines, or the sample points of a continuous density
+    @property
+    def microns(self):
+        return self._microns
+
+    @property
+    def weights(self):
+        return self._weights
+
 class Emitter:
+    # Random samples are drawn in fixed size blocks so any range of rays can be generated on its own
+    BLOCK = 65536
+
     # Takes position, number of rays,
-    def __init__(self, pos, rayNum, dir = 0, size=1, arc=np.pi/2, microns=0.6, type="point"):
-        self.pos = pos
-        self.dir = dir
-        self.size = size
-        self.arc = arc
+    # sampling="uniform" spaces the rays evenly, sampling="random" draws them from a generator seeded with seed
+    # With a Spectrum every ray gets its own wavelength drawn from it, microns is then ignored
+    # Emitters are immutable once created, so the same rays can be reused across traces
+    # The full bundle is only generated when rays is first used, Chunks generates it piece by piece instead
+    def __init__(self, pos, rayNum, dir = 0, size=1, arc=np.pi/2, microns=0.6, type="point", sampling="uniform", seed=None, spectrum=None):
+        self._pos = tuple(pos)
+        self._dir = dir
+        self._size = size
+        self._arc = arc
         self._rayNum = rayNum
-        self.type = type
+        self._type = type
         self._microns = microns
+        self._sampling = sampling
+        self._seed = seed
+        self._spectrum = spectrum
+        # Unseeded emitters still draw the same rays every time they are generated
+        self._entropy = np.random.SeedSequence(seed).entropy
+        self._rays = None
 
-        if type == "point":
-            self.rays = self.GenPointRays()
-        if type == "plane":
-            self.rays = self.GenPlaneRays()
-        if type == "arc":
-            self.rays = self.GenArcRays()
+        if type not in ["point", "plane", "arc"]:
+            raise Exception("emitter has unexpected type {}".format(type))
 
+    # Generates the rays with index start to stop-1 as a ray.RayBundle
+    def GenRays(self, start=0, stop=None):
+        if stop is None:
+            stop = self._rayNum
+        if self._type == "point":
+            b = self.GenPointRays(start, stop)
+        elif self._type == "plane":
+            b = self.GenPlaneRays(start, stop)
+        else:
+            b = self.GenArcRays(start, stop)
+        if self._spectrum is not None:
+            b.microns[:] = self._spectrum.Sample(self.WavelengthSamples(start, stop))
+        return b
 
+    # Yields the rays in bundles of at most chunkSize rays without generating the full bundle
+    def Chunks(self, chunkSize):
+        for start in range(0, self._rayNum, chunkSize):
+            yield self.GenRays(start, min(start + chunkSize, self._rayNum))
 
-    def GenPointRays(self):
-        rays = []
-        angles = np.linspace(-np.pi, np.pi - (2 * np.pi / self._rayNum), self._rayNum)
-        for angle in angles:
-            newRay = ray.Ray(self.pos, angle, microns=self._microns)
-            rays.append(newRay)
-        return rays
+    # Returns the values in [0, 1] of rays start to stop-1, evenly spaced or random depending on the sampling
+    def Samples(self, start, stop, endpoint=True):
+        if stop <= start:
+            return np.zeros(0)
+        if self._sampling == "random":
+            return self.RandomSamples(start, stop, 0)
+        idx = np.arange(start, stop)
+        if not endpoint:
+            return idx / self._rayNum
+        if self._rayNum == 1:
+            return np.zeros(len(idx))
+        return idx / (self._rayNum - 1)
 
-    def GenPlaneRays(self):
-        rays = []
+    # Random values in [0, 1) of rays start to stop-1 from the independent stream
+    # Stream 0 places the rays, stream 1 picks their wavelengths
+    def RandomSamples(self, start, stop, stream=0):
+        blocks = []
+        for block in range(start // self.BLOCK, (stop - 1) // self.BLOCK + 1):
+            spawnKey = (block,) if stream == 0 else (block, stream)
+            rng = np.random.default_rng(np.random.SeedSequence(self._entropy, spawn_key=spawnKey))
+            blocks.append(rng.random(self.BLOCK))
+        offset = (start // self.BLOCK) * self.BLOCK
+        return np.concatenate(blocks)[start - offset:stop - offset]
+
+    # Values in [0, 1) mapped through the spectrum for rays start to stop-1
+    # Uniform sampling uses the golden ratio sequence so neighbouring rays get well spread wavelengths
+    def WavelengthSamples(self, start, stop):
+        if stop <= start:
+            return np.zeros(0)
+        if self._sampling == "random":
+            return self.RandomSamples(start, stop, 1)
+        return np.mod(np.arange(start, stop) * 0.6180339887498949 + 0.5, 1)
+
+    def GenPointRays(self, start=0, stop=None):
+        s = self.Samples(start, stop, endpoint=False)
+        angles = -np.pi + 2 * np.pi * s
+        return ray.RayBundle.FromAngles(np.full(len(s), self._pos[0]), np.full(len(s), self._pos[1]),
+                                        angles, self._microns)
+
+    def GenPlaneRays(self, start=0, stop=None):
         # Get direction of Ray
-        xydir = np.array([np.cos(self.dir), np.sin(self.dir)])
-
-        # Calculate normal of direction
-        xystep = np.random.rand(2)
-        xystep = xystep - xystep.dot(xydir) * xydir
-        xystep = xystep / np.linalg.norm(xystep)
-        xstep = xystep[0] * self.size /2
-        ystep = xystep[1] * self.size /2
-
-        coords = np.linspace([self.pos[0]-xstep,self.pos[1]-ystep],[self.pos[0]+xstep,self.pos[1]+ystep],self._rayNum)
-        for coord in coords:
-            newRay = ray.Ray(coord, self.dir, microns=self._microns)
-            rays.append(newRay)
-        return rays
-
-    def GenArcRays(self):
-        rays = []
-        angles = np.linspace(self.dir - (self.arc/2), self.dir + (self.arc/2), self._rayNum)
-        for angle in angles:
-            newRay = ray.Ray(self.pos, angle, microns=self._microns)
-            rays.append(newRay)
-        return rays
+        xydir = np.array([np.cos(self._dir), np.sin(self._dir)])
+
+        # Normal of direction, rotated a quarter turn counterclockwise
+        xystep = np.array([-xydir[1], xydir[0]])
+        xstep = xystep[0] * self._size /2
+        ystep = xystep[1] * self._size /2
+
+        s = self.Samples(start, stop)
+        x = self._pos[0] - xstep + 2 * xstep * s
+        y = self._pos[1] - ystep + 2 * ystep * s
+        return ray.RayBundle(x, y, np.full(len(s), xydir[0]), np.full(len(s), xydir[1]), self._microns)
+
+    def GenArcRays(self, start=0, stop=None):
+        s = self.Samples(start, stop)
+        angles = self._dir - (self._arc/2) + self._arc * s
+        return ray.RayBundle.FromAngles(np.full(len(s), self._pos[0]), np.full(len(s), self._pos[1]),
+                                        angles, self._microns)
+
+    # Cache key describing the rays of the emitter
+    # Unseeded random emitters draw different rays each, so their entropy is part of the key
+    @property
+    def key(self):
+        key = EmitterKey(self._pos, self._rayNum, self._dir, self._size, self._arc, self._microns, self._type,
+                         self._sampling, self._seed, self._spectrum)
+        if self._sampling == "random" and self._seed is None:
+            key = key + (self._entropy,)
+        return key
+
+    # Rays are stored as a ray.RayBundle, iterating it yields Ray like views
+    @property
+    def rays(self):
+        if self._rays is None:
+            self._rays = self.GenRays()
+            for name in self._rays.FIELDS:
+                getattr(self._rays, name).flags.writeable = False
+        return self._rays
+
+    @property
+    def pos(self):
+        return self._pos
+
+    @property
+    def dir(self):
+        return self._dir
+
+    @property
+    def size(self):
+        return self._size
+
+    @property
+    def arc(self):
+        return self._arc
+
+    @property
+    def type(self):
+        return self._type
 
     @property
     def raynum(self):
         return self._rayNum
 
+    # None for emitters with a spectrum, their rays carry their own wavelengths
     @property
     def microns(self):
-        return self._microns
\ No newline at end of file
+        if self._spectrum is not None:
+            return None
+        return self._microns
+
+    @property
+    def spectrum(self):
+        return self._spectrum
+
+# Emitter of skew rays for the 3D trace mode, every ray goes through one point of a circular pupil of diameter size
+# type="plane" is a collimated beam centered on pos, tilted by the field angle dir in the xy plane
+# type="point" is a point source at pos aimed at the pupil, a disk perpendicular to the x axis centered on pupil (x, y)
+# pattern picks the pupil points:
+#   "grid"       square grid clipped to the pupil through its center, rayNum is rounded to the points inside it
+#   "hexapolar"  the center and rings of 6, 12, 18 ... points, rayNum is rounded up to complete the last ring
+#   "random"     uniform over the pupil area from a generator seeded with seed, exactly rayNum rays
+# Pupil coordinates (u, v) in the unit disk map to y and z, rays are ray.RayBundle3D with z = 0 at the source
+class Emitter3D(Emitter):
+    def __init__(self, pos, rayNum, dir=0, size=1, microns=0.6, type="plane", pattern="hexapolar", pupil=None, seed=None, spectrum=None):
+        if type not in ["point", "plane"]:
+            raise Exception("3D emitter has unexpected type {}".format(type))
+        if pattern not in ["grid", "hexapolar", "random"]:
+            raise Exception("3D emitter has unexpected pattern {}".format(pattern))
+        if type == "point" and pupil is None:
+            raise Exception("point emitters need the pupil center")
+        super().__init__(pos, rayNum, dir, size, 0, microns, type, "random" if pattern == "random" else "uniform", seed, spectrum)
+        self._pattern = pattern
+        self._pupil = None if pupil is None else tuple(pupil)
+        self._pupilPoints = None
+        if pattern != "random":
+            u, v = self.PupilPoints()
+            self._rayNum = len(u)
+
+    # Unit disk coordinates of every ray for the grid and hexapolar patterns, computed once
+    def PupilPoints(self):
+        if self._pupilPoints is None:
+            if self._pattern == "grid":
+                # Odd number of points per side so the pupil center is always on the grid, a single ray for tiny counts
+                side = 2 * max(0, int(round((np.sqrt(4 * self._rayNum / np.pi) - 1) / 2))) + 1
+                axis = np.linspace(-1, 1, side) if side > 1 else np.zeros(1)
+                u, v = np.meshgrid(axis, axis, indexing="ij")
+                inside = u ** 2 + v ** 2 <= 1 + 1e-12
+                self._pupilPoints = (u[inside], v[inside])
+            else:
+                rings = 0
+                while 1 + 3 * rings * (rings + 1) < self._rayNum:
+                    rings += 1
+                radius = [np.zeros(1)]
+                azimuth = [np.zeros(1)]
+                for ring in range(1, rings + 1):
+                    radius.append(np.full(6 * ring, ring / rings))
+                    azimuth.append(2 * np.pi * np.arange(6 * ring) / (6 * ring))
+                radius = np.concatenate(radius)
+                azimuth = np.concatenate(azimuth)
+                self._pupilPoints = (radius * np.cos(azimuth), radius * np.sin(azimuth))
+        return self._pupilPoints
+
+    # Generates the rays with index start to stop-1 as a ray.RayBundle3D
+    def GenRays(self, start=0, stop=None):
+        if stop is None:
+            stop = self._rayNum
+        if self._pattern == "random":
+            # Square root of the radius keeps the density uniform over the area, stream 2 picks the azimuth
+            radius = np.sqrt(self.RandomSamples(start, stop, 0)) if stop > start else np.zeros(0)
+            azimuth = 2 * np.pi * self.RandomSamples(start, stop, 2) if stop > start else np.zeros(0)
+            u = radius * np.cos(azimuth)
+            v = radius * np.sin(azimuth)
+        else:
+            u, v = self.PupilPoints()
+            u = u[start:stop]
+            v = v[start:stop]
+        n = len(u)
+        half = self._size / 2
+        if self._type == "plane":
+            dx, dy = np.cos(self._dir), np.sin(self._dir)
+            # u runs along the direction rotated a quarter turn in the xy plane, v along z
+            x = self._pos[0] - dy * half * u
+            y = self._pos[1] + dx * half * u
+            b = ray.RayBundle3D(x, y, half * v, np.full(n, dx), np.full(n, dy), np.zeros(n), self._microns)
+        else:
+            tx = self._pupil[0] - self._pos[0]
+            ty = self._pupil[1] + half * u - self._pos[1]
+            tz = half * v
+            norm = np.sqrt(tx ** 2 + ty ** 2 + tz ** 2)
+            b = ray.RayBundle3D(np.full(n, self._pos[0]), np.full(n, self._pos[1]), np.zeros(n),
+                                tx / norm, ty / norm, tz / norm, self._microns)
+        if self._spectrum is not None:
+            b.microns[:] = self._spectrum.Sample(self.WavelengthSamples(start, stop))
+        return b
+
+    @property
+    def key(self):
+        return super().key + (self._pattern, self._pupil)
+
+    @property
+    def pattern(self):
+        return self._pattern
+
+    @property
+    def pupil(self):
+        return self._pupil
+
+# Key of the rays of an emitter with these arguments, the Spectrum is described by its key
+# Shared by Emitter.key and GetEmitter
+def EmitterKey(pos, rayNum, dir=0, size=1, arc=np.pi/2, microns=0.6, type="point", sampling="uniform", seed=None, spectrum=None):
+    return (type, tuple(pos), dir, size, arc, rayNum, microns, sampling, seed, None if spectrum is None else spectrum.key)
+
+# Emitters created through GetEmitter, rebuilt from their EmitterKey on a miss
+@functools.lru_cache(maxsize=64)
+def _CachedEmitter(key):
+    type, pos, dir, size, arc, rayNum, microns, sampling, seed, spectrumKey = key
+    spectrum = None if spectrumKey is None else Spectrum(*spectrumKey)
+    return Emitter(pos, rayNum, dir, size, arc, microns, type, sampling, seed, spectrum)
+
+# Same arguments as Emitter, returns a cached emitter when one with the same parameters exists
+# Unseeded random emitters are not reproducible and are never cached
+def GetEmitter(pos, rayNum, dir=0, size=1, arc=np.pi/2, microns=0.6, type="point", sampling="uniform", seed=None, spectrum=None):
+    if sampling == "random" and seed is None:
+        return Emitter(pos, rayNum, dir, size, arc, microns, type, sampling, seed, spectrum)
+    return _CachedEmitter(EmitterKey(pos, rayNum, dir, size, arc, microns, type, sampling, seed, spectrum))
+
+def ClearCache():
+    _CachedEmitter.cache_clear()
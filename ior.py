@@ -1,85 +1,96 @@
-import math
+import functools
 import warnings
+import numpy as np
+
+# Dispersion formulas, all take the wavelength in microns (scalar or array) and a coefficient dictionary
+# Sellmeier: n^2 = 1 + sum(B * l^2 / (l^2 - C))
+def Sellmeier(microns, coeff):
+    lsq = np.asarray(microns, dtype=float) ** 2
+    nsqm1 = 0
+    for b, c in zip(coeff["B"], coeff["C"]):
+        nsqm1 = nsqm1 + (b * lsq) / (lsq - c)
+    return np.sqrt(nsqm1 + 1)
+
+# Cauchy: n = A[0] + A[1] / l^2 + A[2] / l^4 + ...
+def Cauchy(microns, coeff):
+    lsq = np.asarray(microns, dtype=float) ** 2
+    n = 0
+    for idx in range(len(coeff["A"]) - 1, -1, -1):
+        n = n / lsq + coeff["A"][idx]
+    return n
+
+# Gas form used for air: n - 1 = sum(B / (C - 1 / l^2))
+def Gas(microns, coeff):
+    lsq = np.asarray(microns, dtype=float) ** 2
+    nm1 = 0
+    for b, c in zip(coeff["B"], coeff["C"]):
+        nm1 = nm1 + b / (c - (1 / lsq))
+    return nm1 + 1
+
+FORMULAS = {"sellmeier": Sellmeier, "cauchy": Cauchy, "gas": Gas}
+
+# Material registry, the coefficients are data so new glasses only need an entry here or a RegisterMaterial call
+# Coefficients from https://refractiveindex.info, range is the valid wavelength range in microns
+MATERIALS = {
+    # Air from 0.23-1.69um
+    "Air": {"formula": "gas", "B": [0.05792105, 0.00167917], "C": [238.0185, 57.362], "range": (0.23, 1.69)},
+    # N-BK-7 Glass from 0.3-2.5um
+    "BK7": {"formula": "sellmeier", "B": [1.03961212, 0.231792344, 1.01046945],
+            "C": [0.00600069867, 0.0200179144, 103.560653], "range": (0.3, 2.5)},
+    # N-SF-11 Glass from 0.37-2.5um
+    "SF11": {"formula": "sellmeier", "B": [1.73759695, 0.313747346, 1.89878101],
+             "C": [0.013188707, 0.0623068142, 155.23629], "range": (0.37, 2.5)},
+    # CaF2 Glass from 0.23-9.7um
+    "CaF2": {"formula": "sellmeier", "B": [0.5675888, 0.4710914, 3.8484723],
+             "C": [0.050263605, 0.1003909, 34.649040], "range": (0.23, 9.7)},
+    # LAH Glass from 0.32-2.4um
+    "LAH": {"formula": "sellmeier", "B": [1.83021453, 0.29156359, 1.28544024],
+            "C": [0.0090482329, 0.0330756689, 89.3675501], "range": (0.32, 2.4)},
+}
+
+# Adds or replaces a material, coefficients are passed as keywords, e.g. B=[...], C=[...] or A=[...]
+def RegisterMaterial(name, formula, wavelengthRange=(0, np.inf), **coeff):
+    if formula not in FORMULAS:
+        raise Exception("unknown dispersion formula {}".format(formula))
+    MATERIALS[name] = dict(coeff, formula=formula, range=wavelengthRange)
+    _CachedIOR.cache_clear()
+
+# Evaluates the material formula without caching
+def RefractiveIndex(microns, material):
+    coeff = MATERIALS[material]
+    return FORMULAS[coeff["formula"]](microns, coeff)
+
+@functools.lru_cache(maxsize=1024)
+def _CachedIOR(material, microns):
+    return float(RefractiveIndex(microns, material))
+
+# Refractive index of a material, microns can be a scalar or an array of wavelengths
+# Scalars are served from an LRU cache of (material, wavelength), arrays are evaluated once per distinct wavelength
+def GetIOR(microns, material="BK7"):
+    if material not in MATERIALS:
+        warnings.warn("Invalid Material")
+        if np.ndim(microns) == 0:
+            return 1
+        return np.ones(np.shape(microns))
+    if np.ndim(microns) == 0:
+        return _CachedIOR(material, float(microns))
+    microns = np.asarray(microns, dtype=float)
+    values, inverse = np.unique(microns, return_inverse=True)
+    return RefractiveIndex(values, material)[inverse].reshape(microns.shape)
+
 # Refractive Index of air based on wavelength
-# Air from 0.23-1.69um
-# https://refractiveindex.info
 def AirRefractiveIndex(microns):
-    # wavelength squared
-    lsq = microns**2
-    # numerator coefficients
-    coeffa = [0.05792105, 0.00167917]
-    # denominator coefficients
-    coeffb = [238.0185, 57.362]
-    # n minus 1
-    nm1 = coeffa[0]/(coeffb[0]-(1/lsq))+coeffa[1]/(coeffb[1]-(1/lsq))
-    return nm1+1
+    return GetIOR(microns, "Air")
 
 # Refractive Index of the material based on wavelength
-# N-BK-7 Glass from 0.3-2.5um
-# https://refractiveindex.info
 def BK7RefractiveIndex(microns):
-    # wavelength squared
-    lsq = microns**2
-    # numerator coefficients
-    coeffa = [1.03961212, 0.231792344, 1.01046945]
-    # denominator coefficients
-    coeffb = [0.00600069867, 0.0200179144, 103.560653]
-    # n squared minus 1
-    nsqm1 = (coeffa[0]*lsq)/(lsq-coeffb[0])+(coeffa[1]*lsq)/(lsq-coeffb[1])+(coeffa[2]*lsq)/(lsq-coeffb[2])
-    return math.sqrt(nsqm1 + 1)
+    return GetIOR(microns, "BK7")
 
-# Refractive Index of the material based on wavelength
-# N-SF-11 Glass from 0.37-2.5um
-# https://refractiveindex.info
 def SF11RefractiveIndex(microns):
-    # wavelength squared
-    lsq = microns**2
-    # numerator coefficients
-    coeffa = [1.73759695, 0.313747346, 1.89878101]
-    # denominator coefficients
-    coeffb = [0.013188707, 0.0623068142, 155.23629]
-    # n squared minus 1
-    nsqm1 = (coeffa[0]*lsq)/(lsq-coeffb[0])+(coeffa[1]*lsq)/(lsq-coeffb[1])+(coeffa[2]*lsq)/(lsq-coeffb[2])
-    return math.sqrt(nsqm1 + 1)
+    return GetIOR(microns, "SF11")
 
-# Refractive Index of the material based on wavelength
-# CaF2 Glass from 0.23-9.7um
-# https://refractiveindex.info
 def CaF2RefractiveIndex(microns):
-    # wavelength squared
-    lsq = microns**2
-    # numerator coefficients
-    coeffa = [0.5675888, 0.4710914, 3.8484723]
-    # denominator coefficients
-    coeffb = [0.050263605, 0.1003909, 34.649040]
-    # n squared minus 1
-    nsqm1 = (coeffa[0]*lsq)/(lsq-coeffb[0])+(coeffa[1]*lsq)/(lsq-coeffb[1])+(coeffa[2]*lsq)/(lsq-coeffb[2])
-    return math.sqrt(nsqm1 + 1)
+    return GetIOR(microns, "CaF2")
 
-# Refractive Index of the material based on wavelength
-# LAH Glass from 0.32-2.4um
-# https://refractiveindex.info
 def LAHRefractiveIndex(microns):
-    # wavelength squared
-    lsq = microns**2
-    # numerator coefficients
-    coeffa = [1.83021453, 0.29156359, 1.28544024]
-    # denominator coefficients
-    coeffb = [0.0090482329, 0.0330756689, 89.3675501]
-    # n squared minus 1
-    nsqm1 = (coeffa[0]*lsq)/(lsq-coeffb[0])+(coeffa[1]*lsq)/(lsq-coeffb[1])+(coeffa[2]*lsq)/(lsq-coeffb[2])
-    return math.sqrt(nsqm1 + 1)
-
-def GetIOR(microns, material="BK7"):
-    if material == "BK7":
-        return BK7RefractiveIndex(microns)
-    if material == "SF11":
-        return SF11RefractiveIndex(microns)
-    if material == "CaF2":
-        return CaF2RefractiveIndex(microns)
-    if material == "LAH":
-        return LAHRefractiveIndex(microns)
-    if material == "Air":
-        return AirRefractiveIndex(microns)
-    warnings.warn("Invalid Material")
-    return 1
\ No newline at end of file
+    return GetIOR(microns, "LAH")
@@ -0,0 +1,187 @@
+import math
+import numpy as np
+
+# Optional compiled kernels for the surface sag, its derivative and the ray intersection
+# Numba is used when it can be imported, otherwise lens.Sag, lens.SagSlope and
+# raytracer.IntersectSurface keep using their vectorized NumPy versions
+try:
+    import numba
+except ImportError:
+    numba = None
+
+BACKENDS = ["numpy", "numba"]
+_backend = "numba" if numba is not None else "numpy"
+
+# Picks the backend used by the tracer, "auto" selects numba when available
+def SetBackend(name):
+    global _backend
+    if name == "auto":
+        name = "numba" if numba is not None else "numpy"
+    if name not in BACKENDS:
+        raise Exception("unknown backend {}".format(name))
+    if name == "numba" and numba is None:
+        raise Exception("numba backend requested but numba is not installed")
+    _backend = name
+
+def GetBackend():
+    return _backend
+
+def UseNumba():
+    return _backend == "numba"
+
+def _Jit(func):
+    if numba is None:
+        return func
+    # numpy error model so divisions by zero give inf/nan like the NumPy path instead of raising
+    return numba.njit(cache=True, error_model="numpy")(func)
+
+# Converts surface parameters to the fixed types the compiled kernels are specialised for
+def SurfaceArgs(r, k, c, tmax):
+    return float(r), float(k), np.ascontiguousarray(c, dtype=float), float(tmax)
+
+# Scalar sag of the conic + even asphere, same clamping as Lens.Surface
+@_Jit
+def _SagScalar(t, r, k, c, tmax):
+    if r == 0:
+        return 0.0
+    if t >= tmax:
+        t = tmax
+    if t <= -tmax:
+        t = -tmax
+    tsq = t * t
+    sphr = tsq / (r * (1 + math.sqrt(1 - (1 + k) * tsq / (r * r))))
+    poly = 0.0
+    for idx in range(len(c) - 1, -1, -1):
+        poly = poly * tsq + c[idx]
+    return sphr + poly * tsq * tsq
+
+@_Jit
+def _SagSlopeScalar(t, r, k, c, tmax):
+    if r == 0 or t >= tmax or t <= -tmax:
+        return 0.0
+    tsq = t * t
+    sphr = t / (r * math.sqrt(1 - (1 + k) * tsq / (r * r)))
+    poly = 0.0
+    for idx in range(len(c) - 1, -1, -1):
+        poly = poly * tsq + c[idx] * ((idx + 2) * 2)
+    return sphr + poly * tsq * t
+
+@_Jit
+def SagNumba(t, r, k, c, tmax):
+    out = np.empty(t.shape[0])
+    for i in range(t.shape[0]):
+        out[i] = _SagScalar(t[i], r, k, c, tmax)
+    return out
+
+@_Jit
+def SagSlopeNumba(t, r, k, c, tmax):
+    out = np.empty(t.shape[0])
+    for i in range(t.shape[0]):
+        out[i] = _SagSlopeScalar(t[i], r, k, c, tmax)
+    return out
+
+# First root of the conic part along a ray, same rules as raytracer.QuadricRoots
+@_Jit
+def _QuadricRootScalar(a, dx, p, q2, d2, r, k, aperture):
+    curv = 0.0 if r == 0 else 1.0 / r
+    A = curv * ((1 + k) * dx * dx + d2)
+    B = 2 * (curv * (1 + k) * a * dx - dx + curv * p)
+    C = curv * (1 + k) * a * a - 2 * a + curv * q2
+    best = np.inf
+    bestInside = False
+    if abs(A) <= 1e-14 * abs(B):
+        if B == 0:
+            return np.nan
+        t1 = -C / B
+        t2 = np.nan
+    else:
+        disc = B * B - 4 * A * C
+        if disc < 0:
+            return np.nan
+        q = -0.5 * (B + math.copysign(math.sqrt(disc), B))
+        t1 = q / A
+        t2 = C / q if q != 0 else np.nan
+    for root in (t1, t2):
+        if not (math.isfinite(root) and root > 0 and 1 - curv * (1 + k) * (a + dx * root) >= -1e-12):
+            continue
+        inside = q2 + (2 * p + d2 * root) * root <= aperture * aperture
+        if (inside and not bestInside) or (inside == bestInside and root < best):
+            best = root
+            bestInside = inside
+    if not math.isfinite(best):
+        return np.nan
+    return best
+
+# Per ray intersection with the same rules as raytracer.IntersectRevolved
+# The surface is revolved around the x axis through its vertex (vx, vy, 0), meridional rays pass z = dz = 0
+# hybrid starts from the analytic conic root and only iterates for aspheric terms, otherwise Newton starts at the vertex plane
+# Returns t, the local y and z of the hit, the validity mask, the residual and the number of iterations of every ray
+@_Jit
+def IntersectNumba(x, y, z, dx, dy, dz, vx, vy, r, k, c, tmax, maxIter, tol, hybrid, aperture):
+    n = x.shape[0]
+    tOut = np.empty(n)
+    hyOut = np.empty(n)
+    hzOut = np.empty(n)
+    resOut = np.empty(n)
+    valid = np.zeros(n, dtype=np.bool_)
+    iters = np.zeros(n, dtype=np.int32)
+    aspheric = False
+    for idx in range(len(c)):
+        if c[idx] != 0:
+            aspheric = True
+    for i in range(n):
+        a = x[i] - vx
+        b = y[i] - vy
+        e = z[i]
+        t = np.nan
+        if dx[i] != 0 and -a / dx[i] >= 0:
+            t = -a / dx[i]
+        iterate = math.isfinite(t)
+        if hybrid:
+            conic = _QuadricRootScalar(a, dx[i], b * dy[i] + e * dz[i], b * b + e * e, dy[i] * dy[i] + dz[i] * dz[i],
+                                       r, k, aperture)
+            if math.isfinite(conic):
+                t = conic
+                iterate = aspheric
+            elif not aspheric:
+                t = np.nan
+                iterate = False
+        # Bracket of the root, g < 0 at tNeg and g > 0 at tPos once seen
+        tNeg = np.nan
+        tPos = np.nan
+        while iterate and iters[i] < maxIter:
+            iters[i] += 1
+            hy = b + dy[i] * t
+            hz = e + dz[i] * t
+            h = math.sqrt(hy * hy + hz * hz)
+            g = a + dx[i] * t - _SagScalar(h, r, k, c, tmax)
+            # Rate of change of the radial distance along the ray
+            dh = 0.0 if h == 0 else (hy * dy[i] + hz * dz[i]) / h
+            dg = dx[i] - _SagSlopeScalar(h, r, k, c, tmax) * dh
+            if g < 0:
+                tNeg = t
+            else:
+                tPos = t
+            tn = t - g / dg
+            if math.isfinite(tNeg) and math.isfinite(tPos):
+                lo = min(tNeg, tPos)
+                hi = max(tNeg, tPos)
+                # Bisect when the Newton step leaves the bracket
+                if not (tn >= lo and tn <= hi):
+                    tn = (lo + hi) / 2
+            if not math.isfinite(tn):
+                t = np.nan
+                break
+            step = tn - t
+            t = tn
+            if abs(step) <= tol * max(1.0, abs(t - step)) or g == 0:
+                break
+        hy = b + dy[i] * t
+        hz = e + dz[i] * t
+        residual = a + dx[i] * t - _SagScalar(math.sqrt(hy * hy + hz * hz), r, k, c, tmax)
+        tOut[i] = t
+        hyOut[i] = hy
+        hzOut[i] = hz
+        resOut[i] = residual
+        valid[i] = math.isfinite(t) and math.isfinite(residual) and abs(residual) <= 1e-6 and t > 0
+    return tOut, hyOut, hzOut, valid, resOut, iters
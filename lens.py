@@ -2,6 +2,7 @@ import numpy as np
 import math
 import ior
 import json
+import kernels
 
 class Lens(object):
     def __init__(self, pos=[0,0], dir="left", config={}):
@@ -33,6 +34,9 @@ class Lens(object):
 
         # Front Surface
         type = self._config["type"]
+        if type == "cemented":
+            self.PreCalculateCemented()
+            return
         self._r = self._config["radius"]
         self._k = self._config["conic"]
         self._c = np.asarray(self._config["coeff"])
@@ -71,15 +75,47 @@ class Lens(object):
             self._r2 = -tmpr
             self._c2 = -tmpc
 
-        if self._k >= 1:
-            self._max = np.inf
-        else:
-            self._max = np.sqrt(self._r ** 2 / (1 + self._k)) - 0.001
+        self._max = Clamp(self._r, self._k)
+        self._max2 = Clamp(self._r2, self._k2)
 
-        if self._k2 >= 1:
-            self._max2 = np.inf
-        else:
-            self._max2 = np.sqrt(self._r2**2/(1+self._k2)) - 0.001
+        self._thickness = self._config["thickness"]
+        self._media = [self._config["material"]]
+        self._surfaces = [(0, self._r, self._k, self._c, self._max),
+                          (self._thickness, self._r2, self._k2, self._c2, self._max2)]
+
+    # Cemented groups of several elements, surfaces are listed front to back with
+    #   "radii"        signed radius of every surface, positive when the center of curvature is towards +x
+    #   "conics"       optional conic constant of every surface
+    #   "coeffs"       optional asphere coefficients of every surface
+    #   "thicknesses"  center thickness of every element
+    #   "materials"    material of every element
+    # e.g. {"type": "cemented", "diameter": 25.4, "radii": [61.5, -44.2, -128.2], "thicknesses": [6, 2.5], "materials": ["BK7", "SF11"]}
+    def PreCalculateCemented(self):
+        radii = list(self._config["radii"])
+        numSurfaces = len(radii)
+        conics = list(self._config.get("conics") or [0] * numSurfaces)
+        coeffs = [np.asarray(c, dtype=float) for c in (self._config.get("coeffs") or [[]] * numSurfaces)]
+        thicknesses = list(self._config["thicknesses"])
+        materials = list(self._config["materials"])
+        if numSurfaces < 2 or len(conics) != numSurfaces or len(coeffs) != numSurfaces:
+            raise Exception("cemented lens needs at least two surfaces with one conic and coeff entry each")
+        if len(thicknesses) != numSurfaces - 1 or len(materials) != numSurfaces - 1:
+            raise Exception("cemented lens needs one thickness and material per element")
+
+        # Flipping the group reverses the surfaces and mirrors their sag
+        if self._dir == "right":
+            radii = [-r for r in reversed(radii)]
+            conics = conics[::-1]
+            coeffs = [-c for c in reversed(coeffs)]
+            thicknesses = thicknesses[::-1]
+            materials = materials[::-1]
+
+        offsets = np.concatenate([[0], np.cumsum(thicknesses)])
+        self._surfaces = [(offsets[i], radii[i], conics[i], coeffs[i], Clamp(radii[i], conics[i])) for i in range(numSurfaces)]
+        self._thickness = offsets[-1]
+        self._media = materials
+        self._r, self._k, self._c, self._max = self._surfaces[0][1:]
+        self._r2, self._k2, self._c2, self._max2 = self._surfaces[-1][1:]
 
     def FrontEquation(self, t):
         res = self.Surface(t, self._r, self._k, self._c, self._max)
@@ -87,7 +123,13 @@ class Lens(object):
 
     def BackEquation(self, t):
         res = self.Surface(t, self._r2, self._k2, self._c2, self._max2)
-        return [res[0]+self._pos[0]+self._config["thickness"], res[1]+self._pos[1]]
+        return [res[0]+self._pos[0]+self._thickness, res[1]+self._pos[1]]
+
+    # Parametric equation of surface i, counted from the front, used to draw cemented interfaces
+    def SurfaceEquation(self, i, t):
+        offset, r, k, c, max = self._surfaces[i]
+        res = self.Surface(t, r, k, c, max)
+        return [res[0]+self._pos[0]+offset, res[1]+self._pos[1]]
 
     def Surface(self, t, r,k,c, max):
         y = t
@@ -107,8 +149,87 @@ class Lens(object):
 
         return [x,y]
 
+    # Derivative of the surface sag (x) with respect to the height t
+    # Scalar counterpart of SagSlope
+    def SurfaceSlope(self, t, r, k, c, max):
+        if r == 0 or t >= max or t <= -max:
+            return 0
+        sphr = t / (r * math.sqrt(1 - (1 + k) * (t ** 2) / (r ** 2)))
+        poly = 0
+        for idx in range(len(c)):
+            poly = poly + c[idx] * ((idx + 2) * 2) * t ** ((idx + 2) * 2 - 1)
+        return poly + sphr
+
+    # Unit normal of the surface at height t, pointing towards +x
+    def SurfaceNormal(self, t, r, k, c, max):
+        slope = self.SurfaceSlope(t, r, k, c, max)
+        norm = math.sqrt(1 + slope ** 2)
+        return [1 / norm, -slope / norm]
+
+    # Sag, slope and normal of the front and back surfaces
+    # Scalar t uses the math based methods above, arrays use the vectorized module functions
+    def FrontSag(self, t):
+        if np.ndim(t) == 0:
+            return self.Surface(t, self._r, self._k, self._c, self._max)[0]
+        return Sag(t, self._r, self._k, self._c, self._max)
+
+    def BackSag(self, t):
+        if np.ndim(t) == 0:
+            return self.Surface(t, self._r2, self._k2, self._c2, self._max2)[0]
+        return Sag(t, self._r2, self._k2, self._c2, self._max2)
+
+    def FrontSlope(self, t):
+        if np.ndim(t) == 0:
+            return self.SurfaceSlope(t, self._r, self._k, self._c, self._max)
+        return SagSlope(t, self._r, self._k, self._c, self._max)
+
+    def BackSlope(self, t):
+        if np.ndim(t) == 0:
+            return self.SurfaceSlope(t, self._r2, self._k2, self._c2, self._max2)
+        return SagSlope(t, self._r2, self._k2, self._c2, self._max2)
+
+    def FrontNormal(self, t):
+        if np.ndim(t) == 0:
+            return self.SurfaceNormal(t, self._r, self._k, self._c, self._max)
+        return SagNormal(t, self._r, self._k, self._c, self._max)
+
+    def BackNormal(self, t):
+        if np.ndim(t) == 0:
+            return self.SurfaceNormal(t, self._r2, self._k2, self._c2, self._max2)
+        return SagNormal(t, self._r2, self._k2, self._c2, self._max2)
+
+    # Index of the first element, the only one unless the lens is cemented
     def GetIOR(self, microns):
-        return  ior.GetIOR(microns, self._config["material"])
+        return  ior.GetIOR(microns, self._media[0])
+
+    # Surface parameters used by the batched tracer
+    # Returns vertex x, vertex y, radius, conic, coefficients and clamp value
+    @property
+    def frontSurface(self):
+        return (self._pos[0], self._pos[1], self._r, self._k, self._c, self._max)
+
+    @property
+    def backSurface(self):
+        return (self._pos[0] + self._thickness, self._pos[1], self._r2, self._k2, self._c2, self._max2)
+
+    # Every surface front to back in the frontSurface form, two unless the lens is cemented
+    @property
+    def surfaces(self):
+        return [(self._pos[0] + offset, self._pos[1], r, k, c, max) for offset, r, k, c, max in self._surfaces]
+
+    @property
+    def numSurfaces(self):
+        return len(self._surfaces)
+
+    # Material between consecutive surfaces, one per element
+    @property
+    def media(self):
+        return self._media
+
+    # Axial distance from the front to the back vertex
+    @property
+    def thickness(self):
+        return self._thickness
 
     @property
     def pos(self):
@@ -118,6 +239,10 @@ class Lens(object):
     def pos(self, value):
         self._pos = value
 
+    @property
+    def dir(self):
+        return self._dir
+
     @property
     def config(self):
         return self._config
@@ -131,4 +256,56 @@ class Lens(object):
         return self._start
     @property
     def end(self):
-        return self._end
\ No newline at end of file
+        return self._end
+
+# Height the sag is clamped to, hyperbolic and parabolic surfaces are defined for every height
+def Clamp(r, k):
+    if k <= -1:
+        return np.inf
+    return np.sqrt(r ** 2 / (1 + k)) - 0.001
+
+# Axis aligned box of one surface tuple inside the aperture radius, as (xmin, xmax, ymin, ymax)
+def SurfaceBounds(surface, radius, samples=257, margin=1e-3):
+    vx, vy, r, k, c, max = surface
+    x = vx + Sag(np.linspace(-radius, radius, samples), r, k, c, max)
+    return (np.nanmin(x) - margin, np.nanmax(x) + margin, vy - radius - margin, vy + radius + margin)
+
+# Vectorized version of Lens.Surface, returns the sag (x offset) for an array of heights t
+def Sag(t, r, k, c, max):
+    t = np.asarray(t, dtype=float)
+    if kernels.UseNumba():
+        return kernels.SagNumba(t.ravel(), *kernels.SurfaceArgs(r, k, c, max)).reshape(t.shape)
+    if r == 0:
+        return np.zeros_like(t)
+    t = np.clip(t, -max, max)
+    tsq = t ** 2
+    with np.errstate(invalid="ignore"):
+        sphr = tsq / (r * (1 + np.sqrt(1 - (1 + k) * tsq / (r ** 2))))
+    poly = np.zeros_like(t)
+    # Horner evaluation of c0*t^4 + c1*t^6 + ...
+    for idx in range(len(c) - 1, -1, -1):
+        poly = poly * tsq + c[idx]
+    return sphr + poly * tsq * tsq
+
+# Derivative of the sag with respect to t, zero outside of the clamped region
+def SagSlope(t, r, k, c, max):
+    t = np.asarray(t, dtype=float)
+    if kernels.UseNumba():
+        return kernels.SagSlopeNumba(t.ravel(), *kernels.SurfaceArgs(r, k, c, max)).reshape(t.shape)
+    if r == 0:
+        return np.zeros_like(t)
+    inside = np.abs(t) < max
+    t = np.clip(t, -max, max)
+    tsq = t ** 2
+    with np.errstate(invalid="ignore", divide="ignore"):
+        sphr = t / (r * np.sqrt(1 - (1 + k) * tsq / (r ** 2)))
+    poly = np.zeros_like(t)
+    for idx in range(len(c) - 1, -1, -1):
+        poly = poly * tsq + c[idx] * ((idx + 2) * 2)
+    return np.where(inside, sphr + poly * tsq * t, 0.0)
+
+# Vectorized unit normals pointing towards +x, returns the x and y component arrays
+def SagNormal(t, r, k, c, max):
+    slope = SagSlope(t, r, k, c, max)
+    norm = np.sqrt(1 + slope ** 2)
+    return [1 / norm, -slope / norm]
@@ -1,4 +1,5 @@
 import lens
+import surfacetable
 import numpy as np
 import json
 
@@ -12,30 +13,69 @@ class LensAssembly(object):
         self._offsets = []
         self._sensorHeight = 40
         self._sensorOffset = 20
+        self._surfaces = None
+        self._traceCache = {}
+
+    # Cached bundles are per process and are not sent to worker processes
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_traceCache"] = {}
+        return state
 
     def __str__(self):
         ret = ""
         for idx in range(len(self._lenses)):
             l = self._lenses[idx]
             ret = ret + ("Lens {}: offset: {}, type: {}, focallength: {}, material: {}\n"
-                         "\t Description: {}\n").format(idx, self._offsets[idx], l.config.get("type"), l.config.get("focalLength"), l.config.get("material"), l.config.get("description"))
+                         "\t Description: {}\n").format(idx, self._offsets[idx], l.config.get("type"), l.config.get("focalLength"), "/".join(l.media), l.config.get("description"))
         return ret
 
-    def AddLens(self, lensConfig, offset=0,dir="left"):
+    def MakeLens(self, lensConfig, dir="left"):
         if type(lensConfig) == str:
-            self._lenses.append(lens.Lens(self._pos, dir, self._catalog[lensConfig]))
+            return lens.Lens(self._pos, dir, self._catalog[lensConfig])
         elif type(lensConfig) == dict:
-            self._lenses.append(lens.Lens(self._pos, dir, lensConfig))
+            return lens.Lens(self._pos, dir, lensConfig)
         else:
             raise Exception("lens has unexpected value {}".format(type(lensConfig)))
+
+    def AddLens(self, lensConfig, offset=0,dir="left"):
+        self._lenses.append(self.MakeLens(lensConfig, dir))
         self._offsets.append(offset)
         self.CalculateLensPosition()
 
+    # Replaces lens idx keeping its offset, dir defaults to the direction of the replaced lens
+    def SetLens(self, idx, lensConfig, dir=None):
+        if dir is None:
+            dir = self._lenses[idx].dir
+        self._lenses[idx] = self.MakeLens(lensConfig, dir)
+        for cache in self._traceCache.values():
+            cache.Invalidate(self.FirstSurface(idx))
+        self.CalculateLensPosition()
+
     def SetOffset(self, idx, offset):
+        if self._offsets[idx] == offset:
+            return
         self._offsets[idx] = offset
+        # Lens idx and every lens after it moved, cached bundles from its front surface on are stale
+        for cache in self._traceCache.values():
+            cache.Invalidate(self.FirstSurface(idx))
         self.CalculateLensPosition()
 
+    # Intermediate bundles of earlier traces of the rays identified by key, see TraceCache
+    def TraceCache(self, key):
+        if key not in self._traceCache:
+            self._traceCache[key] = TraceCache()
+        return self._traceCache[key]
+
+    def ClearTraceCache(self):
+        self._traceCache.clear()
+
+    # Row of the front surface of lens idx in the surface table
+    def FirstSurface(self, idx):
+        return sum(l.numSurfaces for l in self._lenses[:idx])
+
     def CalculateLensPosition(self):
+        self._surfaces = None
         numLenses = len(self._lenses)
         if numLenses <= 0:
             return
@@ -44,12 +84,34 @@ class LensAssembly(object):
         for i in range(numLenses):
             lensX = prevX + self._offsets[i] + prevThickness
             prevX = lensX
-            prevThickness = self._lenses[i].config["thickness"]
+            prevThickness = self._lenses[i].thickness
             self._lenses[i].pos = [prevX, self._pos[1]]
 
     def SensorEquation(self, t):
+        return [self.sensorX, t]
+
+    # x position of the sensor plane described by SensorEquation
+    @property
+    def sensorX(self):
         lastLens = self._lenses[-1]
-        return [lastLens.pos[0] + lastLens.config["thickness"] + self._sensorOffset,t]
+        return lastLens.pos[0] + lastLens.thickness + self._sensorOffset
+
+    # Bounding slab of every surface, see SurfaceTable.slabs
+    @property
+    def slabs(self):
+        return self.surfaces.slabs
+
+    # Flat surfacetable.SurfaceTable of every lens surface, front to back
+    # Built on first use and rebuilt after CalculateLensPosition moves the lenses
+    @property
+    def surfaces(self):
+        if self._surfaces is None:
+            self._surfaces = surfacetable.SurfaceTable(self._lenses)
+        return self._surfaces
+
+    @property
+    def numSurfaces(self):
+        return sum(l.numSurfaces for l in self._lenses)
 
     @property
     def lenses(self):
@@ -57,4 +119,19 @@ class LensAssembly(object):
 
     @property
     def sensorHeight(self):
-        return self._sensorHeight
\ No newline at end of file
+        return self._sensorHeight
+
+# Bundles of one set of rays cached by raytracer.TraceBundle for incremental retracing
+# entering[s] is an untouched copy of the bundle arriving at row s of the surface table, entering[-1] the bundle
+# leaving the last traced surface
+# segments[s] holds the bundle stored for index s of the trace result, the rays arriving at row s
+# Appending a lens keeps the cache valid, the bundle leaving the old last surface is the one entering the new lens
+class TraceCache:
+    def __init__(self):
+        self.entering = []
+        self.segments = []
+
+    # Drops everything traced through surface idx or later, the bundle entering surface idx stays valid
+    def Invalidate(self, idx):
+        del self.entering[idx + 1:]
+        del self.segments[idx:]
@@ -17,55 +17,9 @@ import emitter
 import ior
 import raytracer
 import lensassembly
-
-def RayTrace(lights, assembly):
-    rays = np.array([])
-    # Rays that go through the final glass element
-    finalrays = np.array([])
-    lenses = assembly.lenses
-    for light in lights:
-        rays = np.append(rays,light.rays)
-        airIOR = ior.AirRefractiveIndex(light.microns)
-        for r in light.rays:
-            # rays.append(r)
-            incidentray = r
-            for i in range(len(lenses)):
-                l = lenses[i]
-                refracted = raytracer.GenerateRefractedRay(incidentray, l, airIOR, l.GetIOR(light.microns))
-                rays = np.append(rays, refracted)
-                if len(refracted) < 2:
-                    break
-                if i == len(lenses) - 1:
-                    finalrays = np.append(finalrays,refracted[1])
-                incidentray = refracted[1]
-
-    return rays, finalrays
-# Calculates the amount of hits on the sensor
-def CalculateHits(finalrays, assembly, sensorDivision = 1000):
-    sensorHeight2 = assembly.sensorHeight / 2
-    division = sensorDivision / sensorHeight2 / 2
-
-    sensorHit = np.zeros(sensorDivision)
-    for r in finalrays:
-        intersection = raytracer.CalculateIntersection(r.Equation, assembly.SensorEquation)
-        if not intersection[1]:
-            continue
-        if intersection[0][0] < 0:
-            continue
-        if np.abs(intersection[0][1]) > sensorHeight2:
-            continue
-        intersectionIdx = (intersection[0][1]+sensorHeight2)*division
-        sensorHit[int(intersectionIdx)] = sensorHit[int(intersectionIdx)]+1
-
-    return sensorHit
-
-def OptimizeHelper(lights, assembly):
-    rays, finalrays =RayTrace(lights, assembly)
-    sensorHit = CalculateHits(finalrays, assembly)
-    hitStdev = np.std(sensorHit)
-    percentHit = np.sum(sensorHit)/(lights[0].raynum * len(lights))
-    return hitStdev, percentHit
-
+import parallel
+import optimizer
+import catalog
 
 def OptimizeFunc(offsets, assembly):
     startTime = timeit.default_timer()
@@ -76,22 +30,23 @@ def OptimizeFunc(offsets, assembly):
     hitStdev = np.zeros(3)
     percentHit = np.zeros(3)
 
+    # Cached emitters, the rays are only generated on the first call
     lights = []
-    lights.append(emitter.Emitter([-1000, 0], RAYS, 0, PLANE_WIDTH, microns=WAVELENGTH_R, type="plane"))
-    lights.append(emitter.Emitter([-1000, 0], RAYS, 0, PLANE_WIDTH, microns=WAVELENGTH_V, type="plane"))
+    lights.append(emitter.GetEmitter([-1000, 0], RAYS, 0, PLANE_WIDTH, microns=WAVELENGTH_R, type="plane"))
+    lights.append(emitter.GetEmitter([-1000, 0], RAYS, 0, PLANE_WIDTH, microns=WAVELENGTH_V, type="plane"))
 
-    hitStdev[0], percentHit[0] = OptimizeHelper(lights, assembly)
+    hitStdev[0], percentHit[0] = optimizer.OptimizeHelper(lights, assembly)
 
     lights = []
-    lights.append(emitter.Emitter([-1000, -emity],RAYS,DIR,size=PLANE_WIDTH, microns=WAVELENGTH_R,type="plane"))
-    lights.append(emitter.Emitter([-1000, -emity], RAYS, DIR, size=PLANE_WIDTH, microns=WAVELENGTH_V, type="plane"))
-    hitStdev[1], percentHit[1] = OptimizeHelper(lights, assembly)
+    lights.append(emitter.GetEmitter([-1000, -emity],RAYS,DIR,size=PLANE_WIDTH, microns=WAVELENGTH_R,type="plane"))
+    lights.append(emitter.GetEmitter([-1000, -emity], RAYS, DIR, size=PLANE_WIDTH, microns=WAVELENGTH_V, type="plane"))
+    hitStdev[1], percentHit[1] = optimizer.OptimizeHelper(lights, assembly)
 
     # lights = []
     #
-    # lights.append(emitter.Emitter([-1000, emity], RAYS, -DIR, size=PLANE_WIDTH, microns=WAVELENGTH_R, type="plane"))
-    # lights.append(emitter.Emitter([-1000, emity], RAYS, -DIR, size=PLANE_WIDTH,microns=WAVELENGTH_V, type="plane"))
-    # hitStdev[2], percentHit[2] = OptimizeHelper(lights, assembly)
+    # lights.append(emitter.GetEmitter([-1000, emity], RAYS, -DIR, size=PLANE_WIDTH, microns=WAVELENGTH_R, type="plane"))
+    # lights.append(emitter.GetEmitter([-1000, emity], RAYS, -DIR, size=PLANE_WIDTH,microns=WAVELENGTH_V, type="plane"))
+    # hitStdev[2], percentHit[2] = optimizer.OptimizeHelper(lights, assembly)
 
     results = np.array([hitStdev[0], hitStdev[1], 1-(percentHit[0] * percentHit[1])])
     weights = np.array([1,0.5,1])
@@ -102,7 +57,9 @@ def OptimizeFunc(offsets, assembly):
     return score
 
 
-def DrawImage(rays, assembly,imageSize=[2000,1000], saveName="default"):
+# accumulate=True renders ray density instead of opaque lines, better suited to large traces
+# Pass a tracestats.TraceStats as stats to record the drawing time in its "render" stage
+def DrawImage(rays, assembly,imageSize=[2000,1000], saveName="default", accumulate=False, stats=None):
     startTime = timeit.default_timer()
 
     lenses = assembly.lenses
@@ -110,6 +67,8 @@ def DrawImage(rays, assembly,imageSize=[2000,1000], saveName="default"):
     PAGE_HEIGHT = imageSize[1]
 
     im = renderer.Renderer(PAGE_WIDTH, PAGE_HEIGHT, scale=10)
+    if stats is not None:
+        im.stats = stats
     for l in lenses:
         im.DrawLens(l)
 
@@ -117,8 +76,11 @@ def DrawImage(rays, assembly,imageSize=[2000,1000], saveName="default"):
 
     im.DrawGrid((10, 10))
 
-    for r in rays:
-        im.DrawRay(r)
+    if accumulate:
+        im.AccumulateRays(rays)
+        im.ResolveAccumulation()
+    else:
+        im.DrawRays(rays)
 
     print("Draw time: {}".format(timeit.default_timer() - startTime))
 
@@ -132,8 +94,8 @@ if __name__ == '__main__':
     FLANGE_DISTANCE = 18    # 18mm for Sony E mount
     SENSOR_HEIGHT = 25.1    # Width of Sony APS-C Sensor
 
-    f = open("Thorlabs.json")
-    lib = json.load(f)
+    # Compiled to Thorlabs.catalog on first use
+    lib = catalog.Open("Thorlabs.json")
 
     lens3 = lensassembly.LensAssembly([0,0],lib, sensorOffset=FLANGE_DISTANCE, sensorHeight=SENSOR_HEIGHT)
     lens3.AddLens("LA1805")# 30mm Focal Length PlanoConvex
@@ -159,7 +121,7 @@ if __name__ == '__main__':
     # lightG = emitter.Emitter([-1000 / 4, 0], RAYS, 0, size=20, arc=ARC, microns=WAVELENGTH_G, type="arc")
     # lightV = emitter.Emitter([-1000 / 4, 176.3 / 4], RAYS, -DIR, size=20,arc=ARC,microns=WAVELENGTH_V, type="arc")
 
-    # rays = RayTrace(lights, lens3)
+    # rays = raytracer.RayTrace(lights, lens3)
     # DrawImage(rays,lens3,saveName="CookeTriplet")
     #
     OPTIMIZE_SCALE_FACTOR = 1000000
@@ -174,6 +136,14 @@ if __name__ == '__main__':
     # scipy.optimize.minimize(OptimizeFunc, x0  / OPTIMIZE_SCALE_FACTOR, (lens3),
     #                         constraints=cons, method='Nelder-Mead',bounds=bounds, options={"maxiter":1000})
 
+    # Parallel population based search, each worker holds its own copy of the assembly and emitters
+    # scenes = [[emitter.Emitter([-1000, 0], RAYS, 0, PLANE_WIDTH, microns=WAVELENGTH_R, type="plane"),
+    #            emitter.Emitter([-1000, 0], RAYS, 0, PLANE_WIDTH, microns=WAVELENGTH_V, type="plane")],
+    #           [emitter.Emitter([-1000, -emity], RAYS, DIR, size=PLANE_WIDTH, microns=WAVELENGTH_R, type="plane"),
+    #            emitter.Emitter([-1000, -emity], RAYS, DIR, size=PLANE_WIDTH, microns=WAVELENGTH_V, type="plane")]]
+    # objective = optimizer.OffsetObjective(lens3, scenes, [1, 0.5, 1])
+    # optimizer.DifferentialEvolution(objective, [(2, 20), (2, 20)], processes=multiprocessing.cpu_count(), maxiter=100)
+
     lights = []
     lights.append(emitter.Emitter([-1000, 0],RAYS,0,PLANE_WIDTH, microns=WAVELENGTH_R,type="plane"))
     lights.append(emitter.Emitter([-1000, 0], RAYS, 0, PLANE_WIDTH, microns=WAVELENGTH_V, type="plane"))
@@ -182,9 +152,11 @@ if __name__ == '__main__':
     # lights.append(emitter.Emitter([-1000, emity], RAYS, -DIR, size=PLANE_WIDTH, microns=WAVELENGTH_R, type="plane"))
     # lights.append(emitter.Emitter([-1000, emity], RAYS, -DIR, size=PLANE_WIDTH,microns=WAVELENGTH_V, type="plane"))
 
-    rays, finalrays = RayTrace(lights, lens3)
+    # Shard the rays over every core, only the final rays are needed for the hit histogram
+    with parallel.TracePool(lens3, multiprocessing.cpu_count()) as pool:
+        finalrays = raytracer.RayTrace(lights, lens3, keepSegments=False, pool=pool).finalrays
 
-    sensorHit = CalculateHits(finalrays, lens3)
+    sensorHit = optimizer.CalculateHits(finalrays, lens3)
 
     sensorHeight = len(sensorHit)/2
 
@@ -201,7 +173,7 @@ if __name__ == '__main__':
     # lights.append(emitter.Emitter([-1000, emity], 20, -DIR, size=PLANE_WIDTH, microns=WAVELENGTH_R, type="plane"))
     # lights.append(emitter.Emitter([-1000, emity], 20, -DIR, size=PLANE_WIDTH,microns=WAVELENGTH_V, type="plane"))
 
-    rays, finalrays = RayTrace(lights, lens3)
+    rays, finalrays = raytracer.RayTrace(lights, lens3)
 
     DrawImage(rays, lens3, saveName="CookeTriplet")
 
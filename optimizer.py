@@ -0,0 +1,128 @@
+import multiprocessing
+import numpy as np
+import scipy
+
+import raytracer
+import sensor
+import tracestats
+
+# Calculates the amount of hits on the sensor
+# The sensor is a vertical line, so the hits are computed analytically for all rays at once
+# The binning time is added to the "sensor" stage of stats
+def CalculateHits(finalrays, assembly, sensorDivision = 1000, stats=tracestats.DISABLED):
+    with stats.Timer("sensor"):
+        return sensor.Sensor.FromAssembly(assembly, rows=sensorDivision).Profile(finalrays).astype(float)
+
+# cache=True retraces only the lenses moved since the last call with the same emitters
+# Pass a tracestats.TraceStats as stats to collect the timings and counters of the trace
+def OptimizeHelper(lights, assembly, cache=False, stats=None):
+    # Only the final rays are needed for the sensor
+    result = raytracer.RayTrace(lights, assembly, keepSegments=False, cache=cache, stats=stats is not None)
+    if stats is not None:
+        stats.Merge(result.stats)
+    else:
+        stats = tracestats.DISABLED
+    sensorHit = CalculateHits(result.finalrays, assembly, stats=stats)
+    hitStdev = np.std(sensorHit)
+    percentHit = np.sum(sensorHit)/(lights[0].raynum * len(lights))
+    return hitStdev, percentHit
+
+# Sensor hit merit of an assembly, lower is better
+# scenes is a list of emitter lists, each traced separately
+# The score is the weighted sum of the hit stdev of every scene plus the last weight times the fraction of rays missing the sensor
+# incremental keeps the trace cache of the assembly, so lenses in front of the first changed one are not retraced
+class HitMerit:
+    def __init__(self, scenes, weights, incremental=True):
+        if len(weights) != len(scenes) + 1:
+            raise Exception("expected {} weights, got {}".format(len(scenes) + 1, len(weights)))
+        self._scenes = scenes
+        self._weights = np.asarray(weights)
+        self._incremental = incremental
+
+    def __call__(self, assembly):
+        hitStdev = np.zeros(len(self._scenes))
+        percentHit = np.zeros(len(self._scenes))
+        for idx in range(len(self._scenes)):
+            hitStdev[idx], percentHit[idx] = OptimizeHelper(self._scenes[idx], assembly, self._incremental)
+        results = np.append(hitStdev, 1 - np.prod(percentHit))
+        return np.sum(results * self._weights)
+
+# Lens spacing objective that can be evaluated in worker processes
+# scenes and weights are scored with HitMerit
+# Offset j of a candidate vector is applied to lens firstIdx + j after multiplying it by scaleFactor
+# screen is an optional callable taking the assembly, e.g. paraxial.Screen, candidates it rejects
+# score penalty without being ray traced
+class OffsetObjective:
+    def __init__(self, assembly, scenes, weights, scaleFactor=1, firstIdx=1, screen=None, penalty=1e6, incremental=True):
+        self._assembly = assembly
+        self._merit = HitMerit(scenes, weights, incremental)
+        self._scaleFactor = scaleFactor
+        self._firstIdx = firstIdx
+        self._screen = screen
+        self._penalty = penalty
+
+    def SetOffsets(self, offsets):
+        offsets = np.asarray(offsets) * self._scaleFactor
+        for idx in range(len(offsets)):
+            self._assembly.SetOffset(idx + self._firstIdx, offsets[idx])
+
+    def __call__(self, offsets):
+        self.SetOffsets(offsets)
+        if self._screen is not None and not self._screen(self._assembly):
+            return self._penalty
+        return self._merit(self._assembly)
+
+    @property
+    def assembly(self):
+        return self._assembly
+
+# Objective copy held by every worker process, set once by the pool initializer
+_objective = None
+
+def _InitWorker(objective):
+    global _objective
+    _objective = objective
+
+# Evaluated in the workers, only the offset vector is sent with each task
+def _EvaluateInWorker(offsets):
+    return _objective(offsets)
+
+# Evaluates many candidate offset vectors concurrently
+# Every worker gets its own copy of the objective, with its assembly and emitters, when the pool starts
+# Instances are map-like, so they can be passed as workers= to scipy.optimize.differential_evolution
+class ParallelEvaluator:
+    def __init__(self, objective, processes=None):
+        self._processes = processes or multiprocessing.cpu_count()
+        # The parent keeps a copy as well for optimizers that evaluate serially, such as the polish step
+        _InitWorker(objective)
+        self._pool = multiprocessing.Pool(self._processes, initializer=_InitWorker, initargs=(objective,))
+
+    # Scores for a list of candidate offset vectors
+    def Evaluate(self, candidates):
+        return np.array(self._pool.map(_EvaluateInWorker, list(candidates)))
+
+    def __call__(self, func, iterable):
+        return self._pool.map(func, iterable)
+
+    def Close(self):
+        self._pool.close()
+        self._pool.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.Close()
+
+    @property
+    def processes(self):
+        return self._processes
+
+# Population based search of the lens offsets with every generation evaluated on a process pool
+# Extra keyword arguments are passed to scipy.optimize.differential_evolution
+def DifferentialEvolution(objective, bounds, processes=None, **kwargs):
+    with ParallelEvaluator(objective, processes) as evaluator:
+        res = scipy.optimize.differential_evolution(_EvaluateInWorker, bounds, workers=evaluator,
+                                                    updating="deferred", **kwargs)
+    objective.SetOffsets(res.x)
+    return res
@@ -0,0 +1,109 @@
+import multiprocessing
+from multiprocessing import shared_memory, resource_tracker
+import numpy as np
+
+import ray
+import raytracer
+import traceresult
+import tracestats
+
+# Record layout used to hand traced segments back through shared memory
+SEGMENT_DTYPE = np.dtype([("x", float), ("y", float), ("dx", float), ("dy", float), ("microns", float),
+                          ("start", float), ("end", float), ("alive", bool), ("surface", np.int32)])
+
+# Assembly copy held by every worker process, set once by the pool initializer
+_assembly = None
+
+def _InitWorker(assembly):
+    global _assembly
+    _assembly = assembly
+
+# Traces one shard inside a worker and writes every stored segment into a new shared memory block
+# Returns the block name, the number of segments per surface and the shard tracestats.TraceStats
+def _TraceShard(args):
+    x, y, dx, dy, rayMicrons, microns, keepSegments, stats = args
+    numSurfaces = _assembly.numSurfaces
+    result = traceresult.TraceResult(numSurfaces, len(x), keepSegments, tracestats.TraceStats() if stats else None)
+    raytracer.TraceBundle(ray.RayBundle(x, y, dx, dy, rayMicrons), _assembly, microns, result)
+
+    bundles = []
+    for idx in range(numSurfaces + 1):
+        if keepSegments or idx == numSurfaces:
+            bundles.append(result.Segments(idx))
+        else:
+            bundles.append(None)
+    counts = [0 if b is None else len(b) for b in bundles]
+    shm = shared_memory.SharedMemory(create=True, size=max(1, sum(counts) * SEGMENT_DTYPE.itemsize))
+    records = np.ndarray(sum(counts), dtype=SEGMENT_DTYPE, buffer=shm.buf)
+    offset = 0
+    for b, n in zip(bundles, counts):
+        if n == 0:
+            continue
+        for name in SEGMENT_DTYPE.names:
+            records[name][offset:offset + n] = getattr(b, name)
+        offset += n
+    del records
+    shm.close()
+    # The parent process unlinks the block once it has copied the segments out
+    resource_tracker.unregister(shm._name, "shared_memory")
+    return shm.name, counts, result.stats if stats else None
+
+# Pool of worker processes that each hold a copy of the assembly
+# The assembly is sent once when the pool starts, later changes to it are not seen by the workers
+class TracePool:
+    def __init__(self, assembly, processes=None):
+        self._processes = processes or multiprocessing.cpu_count()
+        self._numSurfaces = assembly.numSurfaces
+        self._pool = multiprocessing.Pool(self._processes, initializer=_InitWorker, initargs=(assembly,))
+
+    # Same result as raytracer.RayTrace, with every emitter split into shards of at most chunkSize rays
+    # By default each emitter is split into one shard per process
+    # stats=True merges the tracestats.TraceStats of every shard into result.stats
+    def RayTrace(self, lights, keepSegments=True, chunkSize=None, stats=False):
+        tasks = []
+        for light in lights:
+            b = light.rays
+            size = chunkSize or max(1, -(-len(b) // self._processes))
+            for start in range(0, len(b), size):
+                s = slice(start, start + size)
+                tasks.append((b.x[s], b.y[s], b.dx[s], b.dy[s], b.microns[s], light.microns, keepSegments, stats))
+
+        capacity = sum(len(light.rays) for light in lights)
+        result = traceresult.TraceResult(self._numSurfaces, capacity, keepSegments, tracestats.TraceStats() if stats else None)
+        for name, counts, shardStats in self._pool.imap(_TraceShard, tasks):
+            if shardStats is not None:
+                result.stats.Merge(shardStats)
+            shm = shared_memory.SharedMemory(name=name)
+            try:
+                records = np.ndarray(sum(counts), dtype=SEGMENT_DTYPE, buffer=shm.buf)
+                offset = 0
+                for idx, n in enumerate(counts):
+                    if n == 0:
+                        continue
+                    # Store copies the records out of the shared block
+                    result.Store(idx, ray.RayBundle(*[records[field][offset:offset + n] for field in SEGMENT_DTYPE.names]))
+                    offset += n
+                del records
+            finally:
+                shm.close()
+                shm.unlink()
+        return result
+
+    def Close(self):
+        self._pool.close()
+        self._pool.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.Close()
+
+    @property
+    def processes(self):
+        return self._processes
+
+# Convenience wrapper that starts a pool for a single parallel trace
+def RayTraceParallel(lights, assembly, keepSegments=True, processes=None, chunkSize=None, stats=False):
+    with TracePool(assembly, processes) as pool:
+        return pool.RayTrace(lights, keepSegments, chunkSize, stats)
@@ -0,0 +1,125 @@
+import numpy as np
+
+# First order (paraxial) model of a lens assembly using ray transfer matrices
+# Rays are described by their height y and reduced angle n*u, so every matrix has a determinant of 1
+# Distances are along x, positions are absolute x values in the assembly coordinates
+
+# Refraction at a surface with curvature c (1 / radius, 0 for flat) from index n1 to n2
+def RefractionMatrix(c, n1, n2):
+    return np.array([[1.0, 0.0], [-(n2 - n1) * c, 1.0]])
+
+# Propagation over distance d in a medium of index n
+def TransferMatrix(d, n):
+    return np.array([[1.0, d / n], [0.0, 1.0]])
+
+# Surfaces of an assembly as (vertex x, curvature, index before, index after), read from its surface table
+def Surfaces(assembly, microns=0.5876):
+    table = assembly.surfaces
+    before, after = table.Indices(microns)
+    return list(zip(table.vertexX, table.curvature, before, after))
+
+# Paraxial metrics of an assembly at one wavelength
+class ParaxialSystem:
+    def __init__(self, assembly, microns=0.5876):
+        self._surfaces = Surfaces(assembly, microns)
+        if len(self._surfaces) == 0:
+            raise Exception("assembly has no lenses")
+        self._nObject = self._surfaces[0][2]
+        self._nImage = self._surfaces[-1][3]
+
+        m = np.identity(2)
+        prevX = self._surfaces[0][0]
+        for x, c, n1, n2 in self._surfaces:
+            m = RefractionMatrix(c, n1, n2) @ TransferMatrix(x - prevX, n1) @ m
+            prevX = x
+        self._matrix = m
+
+    # System matrix from the first to the last vertex
+    @property
+    def matrix(self):
+        return self._matrix
+
+    @property
+    def power(self):
+        return -self._matrix[1, 0]
+
+    # Effective focal length, infinite for afocal systems
+    @property
+    def efl(self):
+        if self.power == 0:
+            return np.inf
+        return self._nImage / self.power
+
+    # Back focal distance, from the last vertex to the rear focal point
+    @property
+    def bfl(self):
+        if self.power == 0:
+            return np.inf
+        return self._matrix[0, 0] * self._nImage / self.power
+
+    # Front focal distance, from the front focal point to the first vertex
+    @property
+    def ffl(self):
+        if self.power == 0:
+            return np.inf
+        return self._matrix[1, 1] * self._nObject / self.power
+
+    @property
+    def firstVertex(self):
+        return self._surfaces[0][0]
+
+    @property
+    def lastVertex(self):
+        return self._surfaces[-1][0]
+
+    @property
+    def rearFocalPoint(self):
+        return self.lastVertex + self.bfl
+
+    @property
+    def frontFocalPoint(self):
+        return self.firstVertex - self.ffl
+
+    # Principal planes, where the focal lengths are measured from
+    @property
+    def rearPrincipalPlane(self):
+        return self.rearFocalPoint - self.efl
+
+    @property
+    def frontPrincipalPlane(self):
+        return self.frontFocalPoint + self._nObject / self.power if self.power != 0 else np.inf
+
+    # Image distance after the last vertex and lateral magnification for an object at objectDistance before the first vertex
+    def Magnification(self, objectDistance):
+        a, b = self._matrix[0]
+        c, d = self._matrix[1]
+        s = objectDistance / self._nObject
+        denom = c * s + d
+        if denom == 0:
+            return np.inf, np.inf
+        imageDistance = -self._nImage * (a * s + b) / denom
+        return a + c * imageDistance / self._nImage, imageDistance
+
+    # All first order metrics as a dictionary
+    def Metrics(self, objectDistance=None):
+        metrics = {"efl": self.efl, "bfl": self.bfl, "ffl": self.ffl,
+                   "frontPrincipalPlane": self.frontPrincipalPlane, "rearPrincipalPlane": self.rearPrincipalPlane,
+                   "frontFocalPoint": self.frontFocalPoint, "rearFocalPoint": self.rearFocalPoint}
+        if objectDistance is not None:
+            metrics["magnification"], metrics["imageDistance"] = self.Magnification(objectDistance)
+        return metrics
+
+# Screen for optimizer.OffsetObjective, accepts an assembly when its paraxial metrics fall in the given (low, high) ranges
+# e.g. Screen(efl=(20, 40), bfl=(15, 25)), a class so it can be sent to worker processes with the objective
+class Screen:
+    def __init__(self, microns=0.5876, **ranges):
+        self._microns = microns
+        self._ranges = ranges
+
+    def __call__(self, assembly):
+        system = ParaxialSystem(assembly, self._microns)
+        for name, (low, high) in self._ranges.items():
+            value = getattr(system, name)
+            if not (low <= value <= high):
+                return False
+        return True
@@ -0,0 +1,93 @@
+import numpy as np
+
+import raytracer
+import traceresult
+import optimizer
+
+# Streaming trace pipeline
+# Emitters are generated chunk by chunk, every chunk is traced and handed to the attached consumers
+# before the next one is generated, so peak memory depends on chunkSize instead of the total ray count
+
+# Base class of the pipeline consumers
+# needsSegments tells the pipeline to keep every segment of a chunk, otherwise only the final rays are kept
+class Consumer:
+    needsSegments = False
+
+    # Called once per traced chunk with the input bundle, its emitter and the traceresult.TraceResult
+    def Consume(self, chunk, light, result):
+        pass
+
+    # Called after the last chunk, the return value is the result of the consumer
+    def Finish(self):
+        return None
+
+# Builds the sensor hit histogram of optimizer.CalculateHits chunk by chunk
+class SensorHistogram(Consumer):
+    def __init__(self, assembly, sensorDivision=1000):
+        self._assembly = assembly
+        self.hits = np.zeros(sensorDivision)
+
+    def Consume(self, chunk, light, result):
+        self.hits += optimizer.CalculateHits(result.finalrays, self._assembly, len(self.hits))
+
+    def Finish(self):
+        return self.hits
+
+# Splats every segment into the accumulation buffer of a renderer.Renderer
+class RenderAccumulator(Consumer):
+    needsSegments = True
+
+    def __init__(self, im, exposure=1.0):
+        self._im = im
+        self._exposure = exposure
+
+    def Consume(self, chunk, light, result):
+        self._im.AccumulateRays(result.rays)
+
+    def Finish(self):
+        self._im.ResolveAccumulation(self._exposure)
+        return self._im
+
+# Counts emitted rays and the rays leaving the last surface, per wavelength
+# Rays of spectral emitters are counted under their own wavelength
+class TraceStatistics(Consumer):
+    def __init__(self):
+        self.emitted = {}
+        self.transmitted = {}
+
+    @staticmethod
+    def _Count(counts, microns):
+        values, n = np.unique(microns, return_counts=True)
+        for m, c in zip(values.tolist(), n.tolist()):
+            counts[m] = counts.get(m, 0) + c
+
+    def Consume(self, chunk, light, result):
+        self._Count(self.emitted, chunk.microns)
+        self._Count(self.transmitted, result.finalrays.microns)
+
+    def Finish(self):
+        stats = {"emitted": sum(self.emitted.values()), "transmitted": sum(self.transmitted.values()), "wavelengths": {}}
+        for microns in self.emitted:
+            stats["wavelengths"][microns] = {"emitted": self.emitted[microns], "transmitted": self.transmitted.get(microns, 0)}
+        return stats
+
+# Yields the emitter, the input chunk and its traceresult.TraceResult for every chunk of every emitter
+# Every chunk records into the same tracestats.TraceStats when stats is given
+def TraceChunks(lights, assembly, chunkSize=100000, keepSegments=False, stats=None):
+    numSurfaces = assembly.numSurfaces
+    for light in lights:
+        for chunk in light.Chunks(chunkSize):
+            result = traceresult.TraceResult(numSurfaces, len(chunk), keepSegments, stats)
+            with result.stats.Timer("trace"):
+                raytracer.TraceBundle(chunk, assembly, light.microns, result)
+            yield light, chunk, result
+
+# Runs one streaming pass with every consumer attached, returns the list of consumer results
+# Consumer time is added to the "consume" stage of stats
+def RunPipeline(lights, assembly, consumers, chunkSize=100000, stats=None):
+    keepSegments = any(c.needsSegments for c in consumers)
+    for light, chunk, result in TraceChunks(lights, assembly, chunkSize, keepSegments, stats):
+        with result.stats.Timer("consume"):
+            for c in consumers:
+                c.Consume(chunk, light, result)
+    return [c.Finish() for c in consumers]
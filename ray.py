@@ -1,4 +1,5 @@
 import math
+import numpy as np
 
 class Ray:
     def __init__(self, pos ,angle, microns=0.6):
@@ -27,4 +28,132 @@ class Ray:
 
     @property
     def dy(self):
-        return self._dy
\ No newline at end of file
+        return self._dy
+
+
+# Structure of arrays container for many rays
+# Every field is a contiguous NumPy array indexed by ray
+# FIELDS lists the fields in constructor order, Select, Copy and Concatenate go through it
+class RayBundle:
+    FIELDS = ["x", "y", "dx", "dy", "microns", "start", "end", "alive", "surface"]
+    DTYPES = [float, float, float, float, float, float, float, bool, np.int32]
+
+    def __init__(self, x, y, dx, dy, microns=0.6, start=None, end=None, alive=None, surface=None):
+        self.x = np.ascontiguousarray(x, dtype=float)
+        n = len(self.x)
+        self.y = np.ascontiguousarray(y, dtype=float)
+        self.dx = np.ascontiguousarray(dx, dtype=float)
+        self.dy = np.ascontiguousarray(dy, dtype=float)
+        if np.ndim(microns) == 0:
+            self.microns = np.full(n, microns, dtype=float)
+        else:
+            self.microns = np.ascontiguousarray(microns, dtype=float)
+            if self.microns.shape != (n,):
+                self.microns = np.array(np.broadcast_to(self.microns, n))
+        self.start = np.zeros(n) if start is None else np.ascontiguousarray(start, dtype=float)
+        self.end = np.full(n, 100000.0) if end is None else np.ascontiguousarray(end, dtype=float)
+        self.alive = np.ones(n, dtype=bool) if alive is None else np.ascontiguousarray(alive, dtype=bool)
+        self.surface = np.zeros(n, dtype=np.int32) if surface is None else np.ascontiguousarray(surface, dtype=np.int32)
+
+    # Creates a bundle from origins and angles (radians) like the Ray constructor
+    @classmethod
+    def FromAngles(cls, x, y, angle, microns=0.6):
+        return cls(x, y, np.cos(angle), np.sin(angle), microns)
+
+    # Joins several bundles into one
+    @classmethod
+    def Concatenate(cls, bundles):
+        bundles = list(bundles)
+        if len(bundles) == 0:
+            return cls(*[np.zeros(0, dtype=dtype) for dtype in cls.DTYPES])
+        return cls(*[np.concatenate([getattr(b, name) for b in bundles]) for name in cls.FIELDS])
+
+    # Returns a new bundle holding the rays selected by an index array or boolean mask
+    def Select(self, idx):
+        return type(self)(*[getattr(self, name)[idx] for name in self.FIELDS])
+
+    # Select with a slice returns views, Copy always owns its arrays
+    def Copy(self):
+        return type(self)(*[getattr(self, name).copy() for name in self.FIELDS])
+
+    # Position of every ray at parameter t (scalar or per ray array)
+    def Equation(self, t):
+        return [self.dx * t + self.x, self.dy * t + self.y]
+
+    # Compatibility accessor, returns a Ray like view of ray idx
+    def Ray(self, idx):
+        return RayView(self, idx)
+
+    def __len__(self):
+        return len(self.x)
+
+    def __getitem__(self, idx):
+        return RayView(self, idx)
+
+    def __iter__(self):
+        for idx in range(len(self.x)):
+            yield RayView(self, idx)
+
+    @property
+    def angle(self):
+        return np.arctan2(self.dy, self.dx)
+
+
+# Behaves like a Ray but reads and writes a single entry of a RayBundle
+class RayView:
+    def __init__(self, bundle, idx):
+        self._bundle = bundle
+        self._idx = idx
+
+    def Equation(self, t):
+        return [self.dx*t + self._bundle.x[self._idx], self.dy*t + self._bundle.y[self._idx]]
+
+    def SetEnd(self, end):
+        self._bundle.end[self._idx] = end
+
+    def SetStart(self, start):
+        self._bundle.start[self._idx] = start
+
+    @property
+    def pos(self):
+        return [self._bundle.x[self._idx], self._bundle.y[self._idx]]
+
+    @property
+    def angle(self):
+        return math.atan2(self.dy, self.dx)
+
+    @property
+    def microns(self):
+        return self._bundle.microns[self._idx]
+
+    @property
+    def start(self):
+        return self._bundle.start[self._idx]
+
+    @property
+    def end(self):
+        return self._bundle.end[self._idx]
+
+    @property
+    def dx(self):
+        return self._bundle.dx[self._idx]
+
+    @property
+    def dy(self):
+        return self._bundle.dy[self._idx]
+
+
+# Bundle of skew rays for the 3D trace mode, adds z and dz to the fields of RayBundle
+# x stays the optical axis, so a bundle with z = dz = 0 is the meridional 2D bundle
+class RayBundle3D(RayBundle):
+    FIELDS = ["x", "y", "z", "dx", "dy", "dz", "microns", "start", "end", "alive", "surface"]
+    DTYPES = [float, float, float, float, float, float, float, float, float, bool, np.int32]
+
+    def __init__(self, x, y, z, dx, dy, dz, microns=0.6, start=None, end=None, alive=None, surface=None):
+        super().__init__(x, y, dx, dy, microns, start, end, alive, surface)
+        self.z = np.ascontiguousarray(z, dtype=float)
+        self.dz = np.ascontiguousarray(dz, dtype=float)
+
+    # Position of every ray at parameter t (scalar or per ray array)
+    def Equation(self, t):
+        return [self.dx * t + self.x, self.dy * t + self.y, self.dz * t + self.z]
@@ -3,7 +3,10 @@ import scipy
 import ray
 import math
 import lens
-import timeit
+import ior
+import traceresult
+import tracestats
+import kernels
 
 # Calculates refraction angle using Snell's law
 # Input: angle of incidence (radians), material 1 refractive index, material 2 refractive index
@@ -15,20 +18,204 @@ def CalculateRefraction(angle, n1, n2):
     ret = math.asin(sref)
     return ret
 
+# Vector form of Snell's law for arrays of unit directions (dx, dy, dz) and unit surface normals (nx, ny, nz)
+# n1 and n2 may be scalars or per ray arrays, the normals may point either way
+# Returns the refracted unit directions and a total internal reflection mask
+def RefractVectors(dx, dy, dz, nx, ny, nz, n1, n2):
+    cosi = -(dx * nx + dy * ny + dz * nz)
+    # Flip normals that point along the ray so cosi is positive
+    sign = np.where(cosi < 0, -1.0, 1.0)
+    cosi = np.abs(cosi)
+    eta = n1 / n2
+    k = 1 - eta ** 2 * (1 - cosi ** 2)
+    tir = k < 0
+    with np.errstate(invalid="ignore"):
+        f = (eta * cosi - np.sqrt(k)) * sign
+    return eta * dx + f * nx, eta * dy + f * ny, eta * dz + f * nz, tir
+
+# Two component RefractVectors for meridional rays
+def RefractDirections(dx, dy, nx, ny, n1, n2):
+    zeros = np.zeros(np.shape(dx))
+    tx, ty, tz, tir = RefractVectors(dx, dy, zeros, nx, ny, zeros, n1, n2)
+    return tx, ty, tir
+
 # Calculates intersection point, T for both parametric equations
-def CalculateIntersection(f0, f1, x0=[0,0]):
+# Roots fsolve did not converge to, or that leave a distance above tol between the curves, count as misses
+def CalculateIntersection(f0, f1, x0=[0,0], tol=1e-6):
     def DistanceFunc(T):
         r0 = f0(T[0])
         r1 = f1(T[1])
         return [r0[0] - r1[0], r0[1] - r1[1]]
     try:
-        root = scipy.optimize.fsolve(DistanceFunc, x0=x0)
+        root, info, ier, msg = scipy.optimize.fsolve(DistanceFunc, x0=x0, full_output=True)
     except RuntimeError:
         return [[np.nan,np.nan], False]
-    if np.isnan(root[0]) or np.isnan(root[1]):
+    if ier != 1 or np.isnan(root[0]) or np.isnan(root[1]) or np.max(np.abs(info["fvec"])) > tol:
         return [[np.nan,np.nan], False]
     return [root, True]
 
+# First intersection of rays with the conic part of a surface, in local coordinates a = x - vertexX, b = y - vertexY
+# The conic c(1+k)X^2 - 2X + c h^2 = 0 with curvature c = 1/r becomes A t^2 + B t + C = 0 along the ray
+# Only roots ahead of the origin on the sheet described by the sag formula, where 1 - c(1+k)X >= 0, are kept
+# The surface ends at the aperture, so a root with |h| <= aperture is preferred over an earlier one outside it
+# Returns the chosen t, nan for rays that miss the conic
+def ConicRoots(a, b, dx, dy, r, k, aperture=np.inf):
+    return QuadricRoots(a, dx, b * dy, b * b, dy * dy, r, k, aperture)
+
+# ConicRoots written with the transverse terms of the ray, so the same roots serve meridional and skew rays
+# With the transverse offset p0 and direction pd of a ray, h^2 = q2 + 2 p t + d2 t^2 where
+# p = p0 . pd, q2 = p0 . p0 and d2 = pd . pd
+def QuadricRoots(a, dx, p, q2, d2, r, k, aperture=np.inf):
+    curv = 0 if r == 0 else 1 / r
+    A = curv * ((1 + k) * dx * dx + d2)
+    B = 2 * (curv * (1 + k) * a * dx - dx + curv * p)
+    C = curv * (1 + k) * a * a - 2 * a + curv * q2
+    with np.errstate(divide="ignore", invalid="ignore"):
+        disc = B * B - 4 * A * C
+        # Numerically stable pair of roots, both computed without cancellation
+        q = -0.5 * (B + np.copysign(np.sqrt(disc), B))
+        linear = np.abs(A) <= 1e-14 * np.abs(B)
+        t1 = np.where(linear, -C / B, q / A)
+        t2 = np.where(linear, np.nan, C / q)
+        t = np.full(len(a), np.inf)
+        inside = np.zeros(len(a), dtype=bool)
+        for root in (t1, t2):
+            onSheet = 1 - curv * (1 + k) * (a + dx * root) >= -1e-12
+            candidate = np.isfinite(root) & (root > 0) & onSheet
+            rootInside = q2 + (2 * p + d2 * root) * root <= aperture * aperture
+            keep = candidate & ((rootInside & ~inside) | ((rootInside == inside) & (root < t)))
+            t = np.where(keep, root, t)
+            inside |= keep & rootInside
+    return np.where(np.isfinite(t), t, np.nan)
+
+# Calculates the intersection of many rays with a lens surface at once
+# Input: arrays of ray origins (x, y) and unit directions (dx, dy), surface tuple from Lens.frontSurface/backSurface
+# Meridional wrapper around IntersectRevolved with z = dz = 0
+# Returns ray parameter t, surface parameter (local height) and a validity mask
+# diagnostics=True also returns the residual x(t) - vertexX - Sag and the number of iterations of every ray
+def IntersectSurface(x, y, dx, dy, surface, maxIter=20, tol=1e-9, diagnostics=False, solver="hybrid", aperture=np.inf):
+    zeros = np.zeros(np.shape(x))
+    t, h, hz, valid, residual, iters = IntersectRevolved(x, y, zeros, dx, dy, zeros, surface, maxIter, tol, solver, aperture)
+    if diagnostics:
+        return t, h, valid, residual, iters
+    return t, h, valid
+
+# Intersection of rays (x, y, z) + t (dx, dy, dz) with a surface revolved around the x axis through its vertex
+# The sag of Lens.Surface becomes a function of the radial distance h = sqrt(y^2 + z^2) from the axis
+# solver="hybrid" solves the conic part analytically with QuadricRoots and only iterates for the aspheric terms,
+# with Newton steps kept inside the bracket of the root once one is known
+# solver="newton" iterates x(t) - vertexX - Sag(h(t)) = 0 from the vertex plane for every ray
+# aperture is the radius the hybrid solver prefers hits within, see ConicRoots
+# Returns ray parameter t, the local y and z of the hit, a validity mask, the residual and the iterations of every ray
+def IntersectRevolved(x, y, z, dx, dy, dz, surface, maxIter=20, tol=1e-9, solver="hybrid", aperture=np.inf):
+    vx, vy, r, k, c, max = surface
+    x, y, z, dx, dy, dz = [np.asarray(v, dtype=float) for v in (x, y, z, dx, dy, dz)]
+    if solver not in ["hybrid", "newton"]:
+        raise Exception("unknown solver {}".format(solver))
+    if kernels.UseNumba():
+        return kernels.IntersectNumba(x, y, z, dx, dy, dz, float(vx), float(vy), *kernels.SurfaceArgs(r, k, c, max),
+                                      maxIter, tol, solver == "hybrid", float(aperture))
+    return _IntersectNumpy(x, y, z, dx, dy, dz, surface, maxIter, tol, solver == "hybrid", aperture)
+
+def _IntersectNumpy(x, y, z, dx, dy, dz, surface, maxIter, tol, hybrid, aperture):
+    vx, vy, r, k, c, max = surface
+    a = x - vx
+    b = y - vy
+    e = z
+    with np.errstate(divide="ignore", invalid="ignore"):
+        # Start from the plane through the vertex
+        start = -a / dx
+        start = np.where(np.isfinite(start) & (start >= 0), start, np.nan)
+        active = np.isfinite(start)
+        if hybrid:
+            conic = QuadricRoots(a, dx, b * dy + e * dz, b * b + e * e, dy * dy + dz * dz, r, k, aperture)
+            # Pure conics are solved exactly and rays missing them are misses
+            # Aspheres refine the conic root, rays that missed the conic start from the vertex plane
+            if np.any(np.asarray(c) != 0):
+                t = np.where(np.isfinite(conic), conic, start)
+                active = np.isfinite(t)
+            else:
+                t = conic
+                active = np.zeros(len(t), dtype=bool)
+        else:
+            t = start
+        iters = np.zeros(len(t), dtype=np.int32)
+        # Bracket of the root, g < 0 at tNeg and g > 0 at tPos once seen
+        tNeg = np.full(len(t), np.nan)
+        tPos = np.full(len(t), np.nan)
+        for i in range(maxIter):
+            if not active.any():
+                break
+            idx = np.flatnonzero(active)
+            iters[idx] += 1
+            ta = t[idx]
+            hy = b[idx] + dy[idx] * ta
+            hz = e[idx] + dz[idx] * ta
+            h = np.sqrt(hy ** 2 + hz ** 2)
+            g = a[idx] + dx[idx] * ta - lens.Sag(h, r, k, c, max)
+            # Rate of change of the radial distance along the ray
+            dh = np.where(h > 0, (hy * dy[idx] + hz * dz[idx]) / h, 0.0)
+            dg = dx[idx] - lens.SagSlope(h, r, k, c, max) * dh
+            neg = g < 0
+            tNeg[idx[neg]] = ta[neg]
+            tPos[idx[~neg]] = ta[~neg]
+            tn = ta - g / dg
+            lo = np.fmin(tNeg[idx], tPos[idx])
+            hi = np.fmax(tNeg[idx], tPos[idx])
+            bracketed = np.isfinite(tNeg[idx]) & np.isfinite(tPos[idx])
+            # Bisect when the Newton step leaves a known bracket
+            outside = bracketed & ~((tn >= lo) & (tn <= hi))
+            tn = np.where(outside | (bracketed & ~np.isfinite(tn)), (lo + hi) / 2, tn)
+            t[idx] = tn
+            step = tn - ta
+            done = (np.abs(step) <= tol * np.maximum(1, np.abs(ta))) | (g == 0)
+            active[idx[done | ~np.isfinite(tn)]] = False
+
+        hy = b + dy * t
+        hz = e + dz * t
+        residual = a + dx * t - lens.Sag(np.sqrt(hy ** 2 + hz ** 2), r, k, c, max)
+    valid = np.isfinite(t) & np.isfinite(residual) & (np.abs(residual) <= 1e-6) & (t > 0)
+    return t, hy, hz, valid, residual, iters
+
+# Unit normals pointing towards +x of a revolved surface at local hit coordinates (hy, hz)
+# Returns the x, y and z component arrays, hz = 0 gives the meridional normals of lens.SagNormal
+def RevolvedNormal(hy, hz, r, k, c, max):
+    h = np.sqrt(hy ** 2 + hz ** 2)
+    slope = lens.SagSlope(h, r, k, c, max)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        radial = np.where(h > 0, slope / h, 0.0)
+    ny = -radial * hy
+    nz = -radial * hz
+    norm = np.sqrt(1 + ny ** 2 + nz ** 2)
+    return 1 / norm, ny / norm, nz / norm
+
+# Range of the ray parameter t where p + t*d lies between lo and hi, along one axis
+# Rays parallel to the axis are inside for every t or for none
+def _SlabInterval(p, d, lo, hi):
+    with np.errstate(divide="ignore", invalid="ignore"):
+        t0 = (lo - p) / d
+        t1 = (hi - p) / d
+    parallel = d == 0
+    inside = (p >= lo) & (p <= hi)
+    tmin = np.where(parallel, np.where(inside, -np.inf, np.inf), np.minimum(t0, t1))
+    tmax = np.where(parallel, np.where(inside, np.inf, -np.inf), np.maximum(t0, t1))
+    return tmin, tmax
+
+# Returns a mask of the rays that enter the slab (xmin, xmax, ymin, ymax) ahead of their origin
+# Skew rays also pass z and dz, the surface stays within the same half height around the axis along z
+def CullSlab(x, y, dx, dy, slab, z=None, dz=None):
+    xmin, xmax, ymin, ymax = slab
+    txmin, txmax = _SlabInterval(x, dx, xmin, xmax)
+    tymin, tymax = _SlabInterval(y, dy, ymin, ymax)
+    tmin = np.maximum(txmin, tymin)
+    tmax = np.minimum(txmax, tymax)
+    if z is not None:
+        half = (ymax - ymin) / 2
+        tzmin, tzmax = _SlabInterval(z, dz, -half, half)
+        tmin = np.maximum(tmin, tzmin)
+        tmax = np.minimum(tmax, tzmax)
+    return np.maximum(tmin, 0) <= tmax
+
 # Calculates the tangent slope of a parametric equation f(t) at point t
 # Epsilon determines how close to t the tangent should be estimated
 def CalculateTangent(f, t, epsilon = 0.001):
@@ -45,13 +232,12 @@ def CalculateNormal(xy):
 # Calculates indicent angle between two equations at a given point
 # In this case, T is derived from result.x
 def CalculateIncidentAngle(f0, f1, T):
-    startTime = timeit.default_timer()
     f0t = CalculateTangent(f0, T[0])
     f1t = CalculateTangent(f1, T[1])
     # Find normal of tangent
     f1n = CalculateNormal(f1t)
     if (f0t[0] == 0):
-        f01 = math.pi/2
+        f0a = math.pi/2
     else:
         f0a = math.atan(f0t[1] / f0t[0])
     if (f1n[0] == 0):
@@ -62,70 +248,219 @@ def CalculateIncidentAngle(f0, f1, T):
 
     return angle
 
-# Calculates the refracted ray given the:
-# Ray Object, Lens Object, IOR of material 1 and IOR of material 2, wavelength of light
-def GenerateRefractedRay(r, l, n0, n1):
-    radius = l.config["diameter"]/2
-    ### Front Surface ###
+# Calculates the incident angle of a ray on a surface from the analytic surface normal
+# Returns the incident angle and the angle of the normal relative to the x axis
+def CalculateNormalIncidentAngle(r, normal):
+    la = math.atan2(normal[1], normal[0])
+    if r.dx == 0:
+        ra = math.pi/2
+    else:
+        ra = math.atan(r.dy / r.dx)
+    return ra - la, la
+
+# Single ray wrapper around IntersectSurface, returns the same [[t, surface t], success] form as CalculateIntersection
+def IntersectRay(r, surface, aperture=np.inf):
+    t, h, valid = IntersectSurface([r.pos[0]], [r.pos[1]], [r.dx], [r.dy], surface, aperture=aperture)
+    if not valid[0]:
+        return [[np.nan, np.nan], False]
+    return [[t[0], h[0]], True]
+
+# Refracts a single ray at one surface tuple from index n0 to n1
+# Sets the end of r and returns the refracted ray, None when the surface is missed
+def RefractRay(r, surface, radius, n0, n1):
     req = r.Equation
-    leq = l.FrontEquation
 
-    x0 = [(l.pos[0] - r.pos[0]) / r.dx, 0]
-    if (x0[0] < 0):
-        return []
-    intersection = CalculateIntersection(req, leq, x0=x0)
+    intersection = IntersectRay(r, surface, radius)
 
     if not intersection[1]:
-        return []
+        return None
     if abs(intersection[0][1]) > radius:
-        return []
+        return None
 
-    incident = CalculateIncidentAngle(req, leq, intersection[0])
+    # Normal angle relative to x axis from the analytic surface normal
+    vx, vy, rad, k, c, max = surface
+    nx, ny = lens.SagNormal(intersection[0][1], rad, k, c, max)
+    incident, la = CalculateNormalIncidentAngle(r, [float(nx), float(ny)])
     refraction = CalculateRefraction(incident, n0, n1)
 
-    # Find normal to front or back surface
-    lt = CalculateTangent(leq, intersection[0][1])
-    ln = CalculateNormal(lt)
-
-    # Find normal angle relative to x axis
-    la = math.atan(ln[1]/ln[0])
-
     # Ray angle
     ra = la + refraction
 
-    fRay = ray.Ray(req(intersection[0][0]-0.001), ra,r.microns)
+    refracted = ray.Ray(req(intersection[0][0]-0.001), ra, r.microns)
 
     r.SetEnd(intersection[0][0])
 
-### Back Surface ###
-    req = fRay.Equation
-    leq = l.BackEquation
+    return refracted
 
-    x0 = [(l.pos[0] - r.pos[0]) / r.dx, 0]
-    # x0 = [np.sqrt((l.pos[0]-r.pos[0])**2 + (l.pos[1]-r.pos[1])**2), 0]
-    if (x0[0] < 0):
-        return [fRay]
-    intersection = CalculateIntersection(req, leq, x0=x0)
-    if not intersection[1]:
-        return [fRay]
-    if abs(intersection[0][1]) > radius:
-        return [fRay]
+# Calculates the refracted ray given the:
+# Ray Object, Lens Object, IOR of material 1 and IOR of material 2, wavelength of light
+# Returns the rays leaving every surface of the lens up to the first one that is missed
+def GenerateRefractedRay(r, l, n0, n1):
+    radius = l.config["diameter"]/2
+    # Index of every medium crossed, the elements of a cemented lens use their own materials
+    if l.numSurfaces == 2:
+        indices = [n0, n1, n0]
+    else:
+        indices = [n0] + [ior.GetIOR(r.microns, m) for m in l.media] + [n0]
+    rays = []
+    incident = r
+    for i, surface in enumerate(l.surfaces):
+        refracted = RefractRay(incident, surface, radius, indices[i], indices[i + 1])
+        if refracted is None:
+            break
+        rays.append(refracted)
+        incident = refracted
+    return rays
 
-    incident = CalculateIncidentAngle(req, leq, intersection[0])
-    refraction = CalculateRefraction(incident, n1, n0)
+# Refracts every live ray of a bundle at one lens surface, the bundle version of RefractRay
+# b is a ray.RayBundle or a ray.RayBundle3D of skew rays, meridional bundles are traced with z = dz = 0
+# Sets the end of the incident rays that hit and kills the ones that miss or are totally internally reflected
+# n0 and n1 are scalars or per ray arrays aligned with b
+# slab is the bounding box of the surface from SurfaceTable.slabs, used to cull rays before intersecting
+# Returns the bundle of refracted rays, of the same type as b
+def RefractBundle(b, surface, radius, n0, n1, surfaceIdx, slab=None, stats=tracestats.DISABLED):
+    skew = isinstance(b, ray.RayBundle3D)
+    idx = np.flatnonzero(b.alive)
+    stats.Count(surfaceIdx, "rays", len(idx))
+    if slab is not None:
+        with stats.Timer("cull"):
+            # Rays that never enter the bounding slab cannot hit the aperture, drop them before root finding
+            if skew:
+                inside = CullSlab(b.x[idx], b.y[idx], b.dx[idx], b.dy[idx], slab, b.z[idx], b.dz[idx])
+            else:
+                inside = CullSlab(b.x[idx], b.y[idx], b.dx[idx], b.dy[idx], slab)
+            b.alive[idx[~inside]] = False
+            idx = idx[inside]
+        stats.Count(surfaceIdx, "culled", len(inside) - len(idx))
+    if skew:
+        z = b.z[idx]
+        dz = b.dz[idx]
+    else:
+        z = np.zeros(len(idx))
+        dz = z
+    with stats.Timer("intersection"):
+        t, hy, hz, valid, residual, iters = IntersectRevolved(b.x[idx], b.y[idx], z, b.dx[idx], b.dy[idx], dz, surface,
+                                                              aperture=radius)
+    if stats.enabled:
+        stats.Count(surfaceIdx, "iterations", iters.sum())
+        stats.Count(surfaceIdx, "failed", np.count_nonzero(~valid))
+    hit = valid
+    valid = valid & (hy ** 2 + hz ** 2 <= radius ** 2)
+    if stats.enabled:
+        stats.Count(surfaceIdx, "vignetted", np.count_nonzero(hit) - np.count_nonzero(valid))
+    b.alive[idx[~valid]] = False
+    idx = idx[valid]
+    t = t[valid]
+    z = z[valid]
+    dz = dz[valid]
+    b.end[idx] = t
 
-    # Find normal to front or back surface
-    lt = CalculateTangent(leq, intersection[0][1])
-    ln = CalculateNormal(lt)
+    with stats.Timer("normal"):
+        vx, vy, r, k, c, max = surface
+        nx, ny, nz = RevolvedNormal(hy[valid], hz[valid], r, k, c, max)
+    with stats.Timer("refraction"):
+        # Per ray indices are aligned with the whole bundle
+        if np.ndim(n0) > 0:
+            n0 = n0[idx]
+        if np.ndim(n1) > 0:
+            n1 = n1[idx]
+        tx, ty, tz, tir = RefractVectors(b.dx[idx], b.dy[idx], dz, nx, ny, nz, n0, n1)
 
-    # Find normal angle relative to x axis
-    la = math.atan(ln[1] / ln[0])
+        b.alive[idx[tir]] = False
+        keep = ~tir
+        idx = idx[keep]
+        t = t[keep] - 0.001
 
-    # Ray angle
-    ra = la + refraction
+        # Start the refracted rays just before the surface like RefractRay
+        hx = b.x[idx] + b.dx[idx] * t
+        hy = b.y[idx] + b.dy[idx] * t
+        if skew:
+            refracted = ray.RayBundle3D(hx, hy, z[keep] + dz[keep] * t, tx[keep], ty[keep], tz[keep], b.microns[idx])
+        else:
+            refracted = ray.RayBundle(hx, hy, tx[keep], ty[keep], b.microns[idx])
+        refracted.surface[:] = surfaceIdx
+    if stats.enabled:
+        stats.Count(surfaceIdx, "tir", np.count_nonzero(tir))
+    stats.Count(surfaceIdx, "refracted", len(idx))
+    return refracted
+
+# Traces a bundle of one wavelength through every row of the assembly surface table
+# b is a ray.RayBundle, or a ray.RayBundle3D for the skew rays of the 3D mode
+# microns=None uses the wavelength of every ray instead, so a whole spectrum is traced in one pass
+# Segments are stored into result when given, returns the bundle leaving the last surface
+# With a cacheKey the intermediate bundles are kept in assembly.TraceCache(cacheKey) and the next trace
+# with the same key restarts from the front surface of the first lens moved by LensAssembly.SetOffset
+# Timings and counters go to stats, which defaults to the tracestats.TraceStats of result
+def TraceBundle(b, assembly, microns, result=None, cacheKey=None, stats=None):
+    if stats is None:
+        stats = tracestats.DISABLED if result is None else result.stats
+    table = assembly.surfaces
+    numSurfaces = len(table)
+    incident = b
+    first = 0
+    cache = None
+    if cacheKey is not None:
+        cache = assembly.TraceCache(cacheKey)
+        if len(cache.entering) == 0:
+            cache.entering.append(b.Copy())
+        first = len(cache.segments)
+        incident = cache.entering[first].Copy()
+        if result is not None:
+            with stats.Timer("store"):
+                for i in range(first):
+                    result.Store(i, cache.segments[i])
 
-    bRay = ray.Ray(req(intersection[0][0]-0.001), ra, r.microns)
+    perRay = microns is None
+    with stats.Timer("ior"):
+        # Vectorized lookups, every material is evaluated once for the whole bundle
+        before, after = table.Indices(incident.microns if perRay else microns)
+    # Per ray indices stay aligned with the bundle that entered the loop, origin maps the surviving rays back to it
+    origin = np.arange(len(incident)) if perRay else None
+    for i in range(first, numSurfaces):
+        n0 = before[i]
+        n1 = after[i]
+        if perRay:
+            n0 = n0[origin]
+            n1 = n1[origin]
+        refracted = RefractBundle(incident, table.Surface(i), table.apertures[i], n0, n1, i + 1, table.slabs[i], stats)
+        if perRay:
+            # The rays still alive in incident are the ones refracted, in the same order
+            origin = origin[incident.alive]
+        if result is not None:
+            with stats.Timer("store"):
+                result.Store(i, incident)
+        if cache is not None:
+            cache.segments.append(incident)
+            cache.entering.append(refracted.Copy())
+        incident = refracted
+    if result is not None:
+        with stats.Timer("store"):
+            result.Store(numSurfaces, incident)
+    return incident
 
-    fRay.SetEnd(intersection[0][0])
+# Traces every emitter through the lens assembly
+# keepSegments=False only stores the rays leaving the final surface, which is all the sensor needs
+# Passing a parallel.TracePool built for the assembly shards the rays over its worker processes
+# cache=True keeps the intermediate bundles of every emitter on the assembly, so retracing after
+# LensAssembly.SetOffset only traces the surfaces that moved
+# stats=True records stage timings and per surface counters in result.stats
+# emitter.Emitter3D lights are traced as skew rays, every light of one trace has to be of the same kind
+# Returns a traceresult.TraceResult, which also unpacks as rays, finalrays
+def RayTrace(lights, assembly, keepSegments=True, pool=None, cache=False, stats=False):
+    bundleTypes = {type(light.rays) for light in lights}
+    if len(bundleTypes) > 1:
+        raise Exception("cannot trace meridional and skew rays together")
+    bundleType = bundleTypes.pop() if bundleTypes else ray.RayBundle
+    if pool is not None:
+        if bundleType is not ray.RayBundle:
+            raise Exception("parallel traces only support meridional rays")
+        return pool.RayTrace(lights, keepSegments, stats=stats)
+    numSurfaces = assembly.numSurfaces
+    capacity = sum(len(light.rays) for light in lights)
+    result = traceresult.TraceResult(numSurfaces, capacity, keepSegments, tracestats.TraceStats() if stats else None,
+                                     bundleType)
+    for light in lights:
+        with result.stats.Timer("trace"):
+            TraceBundle(light.rays.Copy(), assembly, light.microns, result, light.key if cache else None)
 
-    return  [fRay, bRay]
\ No newline at end of file
+    return result
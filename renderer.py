@@ -5,6 +5,7 @@ import timeit
 
 import ray
 import lens
+import tracestats
 
 class Renderer:
     def __init__(self, width=512, height=512, scale=1,bg=(255,255,255)):
@@ -14,6 +15,10 @@ class Renderer:
         self.bg = bg
         self.image = Image.new(mode="RGB", size=(self.width, self.height), color = bg)
         self.drawing = ImageDraw.Draw(self.image)
+        # float32 hit buffer used by AccumulateRays
+        self.accumulation = None
+        # Drawing time is added to the "render" stage, assign a tracestats.TraceStats to record it
+        self.stats = tracestats.DISABLED
 
     # Converts x and y values to local grid
     # Local grid centers image around 0,0
@@ -22,36 +27,119 @@ class Renderer:
         newY = int(self.height / 2 - coords[1] * self.scale)
         return (newX, newY)
 
+    # Pixel coordinates for arrays of x and y, same rounding as ConvertXY
+    def ConvertXYArray(self, x, y):
+        newX = (self.width / 2 + np.asarray(x) * self.scale).astype(int)
+        newY = (self.height / 2 - np.asarray(y) * self.scale).astype(int)
+        return newX, newY
+
+    # Image contents as a writable array, pass it to SetBuffer after editing
+    def GetBuffer(self):
+        return np.array(self.image)
+
+    def SetBuffer(self, buf):
+        self.image = Image.fromarray(buf, mode="RGB")
+        self.drawing = ImageDraw.Draw(self.image)
+
+    # Sets every in bounds pixel to color, colors can be one tuple or one row per pixel
+    def PutPixels(self, px, py, color):
+        inside = (px >= 0) & (px < self.width) & (py >= 0) & (py < self.height)
+        color = np.asarray(color, dtype=np.uint8)
+        if color.ndim > 1:
+            color = color[inside]
+        buf = self.GetBuffer()
+        buf[py[inside], px[inside]] = color
+        self.SetBuffer(buf)
+
     # Draws parametric equation
+    # The curve is sampled into arrays and written in one pass, it stops at the first NaN
+    # or once it is outside of the image and moving away from the origin
     def DrawEquation(self, f, tmin, tmax, step=-1,color=(0,0,0)):
         if step == -1:
             step = 1/self.scale
-        inDrawing = True
-        prevDist = np.inf
-        for t in np.arange(tmin, tmax+step, step):
-            coords = f(t)
-            if np.isnan(coords[0]) or np.isnan(coords[1]):
-                return
-            localCoords = self.ConvertXY(coords)
-            dist = coords[0]**2 + coords[1]**2
-            if localCoords[0] < 0 or localCoords[0] >= self.width:
-                if dist >= prevDist:
-                    return
-                prevDist = dist
-                continue
-            elif localCoords[1] >= self.height or localCoords[1] < 0:
-                if dist >= prevDist:
-                    return
-                prevDist = dist
-                continue
-            self.drawing.point(localCoords, fill=color)
-            # self.image.putpixel(localCoords, color)
+        ts = np.arange(tmin, tmax+step, step)
+        if len(ts) == 0:
+            return
+        coords = np.array([f(t) for t in ts], dtype=float)
+        end = len(ts)
+        nans = np.flatnonzero(np.isnan(coords).any(axis=1))
+        if len(nans) > 0:
+            end = nans[0]
+        px, py = self.ConvertXYArray(coords[:end, 0], coords[:end, 1])
+        dist = coords[:end, 0]**2 + coords[:end, 1]**2
+        outside = np.flatnonzero((px < 0) | (px >= self.width) | (py < 0) | (py >= self.height))
+        away = np.flatnonzero(dist[outside][1:] >= dist[outside][:-1])
+        if len(away) > 0:
+            end = outside[away[0] + 1]
+        self.PutPixels(px[:end], py[:end], color)
 
     def DrawRay(self, r):
         startXY = self.ConvertXY(r.Equation(r.start))
         endXY = self.ConvertXY(r.Equation(r.end))
         self.drawing.line([startXY,endXY],fill=(WavelengthToRGB(r.microns)))
 
+    # Draws every ray of a ray.RayBundle at once
+    # Segments are clipped to the image and rasterized into the image buffer in chunks of at most maxPixels
+    def DrawRays(self, rays, maxPixels=2**22):
+        with self.stats.Timer("render"):
+            x0, y0, x1, y1, color, count, colors = self.PixelSegments(rays)
+            buf = self.GetBuffer()
+            for px, py, seg in RasterizeSegments(x0, y0, x1, y1, self.width, self.height, maxPixels):
+                buf[py, px] = colors[color[seg]]
+            self.SetBuffer(buf)
+
+    # Clips the rays of a bundle to the image and rounds them to pixel end points
+    # Dense bundles overlap heavily, so segments with the same pixel end points and wavelength are merged
+    # Returns the end points, a color index and the number of merged rays per segment, and the colors
+    def PixelSegments(self, rays):
+        x0, y0 = self.ConvertXYFloat(*rays.Equation(rays.start))
+        x1, y1 = self.ConvertXYFloat(*rays.Equation(rays.end))
+        values, colorIdx = np.unique(rays.microns, return_inverse=True)
+        x0, y0, x1, y1, visible = ClipSegments(x0, y0, x1, y1, self.width, self.height)
+        coords = [np.rint(v[visible]).astype(np.int64) for v in (x0, y0, x1, y1)]
+        (x0, y0, x1, y1, color), count = UniqueRows(coords + [colorIdx.ravel()[visible].astype(np.int64)])
+        return x0, y0, x1, y1, color, count, WavelengthToRGBArray(values)
+
+    # Accumulation mode, splats rays into a float32 per channel hit buffer instead of drawing opaque lines
+    # Each ray adds its wavelength color to every pixel it crosses
+    # Can be called once per chunk of a trace, memory only depends on the image size
+    def AccumulateRays(self, rays, maxPixels=2**22):
+        with self.stats.Timer("render"):
+            if self.accumulation is None:
+                self.accumulation = np.zeros((self.height, self.width, 3), dtype=np.float32)
+            x0, y0, x1, y1, color, count, colors = self.PixelSegments(rays)
+            weights = colors.astype(np.float64) / 255
+            acc = self.accumulation.reshape(-1, 3)
+            for px, py, seg in RasterizeSegments(x0, y0, x1, y1, self.width, self.height, maxPixels):
+                flat = py * self.width + px
+                for c in range(3):
+                    w = weights[color[seg], c] * count[seg]
+                    acc[:, c] += np.bincount(flat, weights=w, minlength=len(acc)).astype(np.float32)
+
+    # Tone maps the accumulated hits onto the image
+    # Intensity is compressed logarithmically relative to the brightest pixel, exposure scales it before compression
+    def ResolveAccumulation(self, exposure=1.0):
+        if self.accumulation is None:
+            return
+        intensity = self.accumulation.max(axis=2)
+        peak = intensity.max()
+        if peak <= 0:
+            return
+        tone = np.log1p(intensity * exposure) / np.log1p(peak * exposure)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            chroma = np.where(intensity[..., None] > 0, self.accumulation / intensity[..., None], 0)
+        buf = self.GetBuffer().astype(np.float32)
+        tone = np.clip(tone, 0, 1)[..., None]
+        buf = buf * (1 - tone) + chroma * 255 * tone
+        self.SetBuffer(np.clip(np.rint(buf), 0, 255).astype(np.uint8))
+
+    def ClearAccumulation(self):
+        self.accumulation = None
+
+    # Like ConvertXYArray but without rounding, used for clipping
+    def ConvertXYFloat(self, x, y):
+        return self.width / 2 + np.asarray(x) * self.scale, self.height / 2 - np.asarray(y) * self.scale
+
     def DrawLens(self, l, detail=50):
         points = []
         for i in np.linspace(l.start, l.end, detail):
@@ -59,17 +147,19 @@ class Renderer:
         for i in np.linspace(l.end, l.start, detail):
             points.append(tuple(self.ConvertXY(l.BackEquation(i))))
         self.drawing.polygon(points, outline=(0,0,0))
+        # Interfaces between the elements of a cemented lens
+        for surface in range(1, l.numSurfaces - 1):
+            interface = [tuple(self.ConvertXY(l.SurfaceEquation(surface, i))) for i in np.linspace(l.start, l.end, detail)]
+            self.drawing.line(interface, fill=(0,0,0))
 
     def DrawGrid(self, interval=(10,10), color=(100,100,100)):
-        for x in range(-int(self.width / 2), int(self.width / 2)):
-            for y in range(-int(self.height / 2), int(self.height / 2)):
-                if x % (interval[0]) == 0 and y % (interval[1]) == 0:
-                    localCoords = self.ConvertXY((x,y))
-                    if localCoords[0] < 0 or localCoords[0] >= self.width:
-                        continue
-                    if localCoords[1] >= self.height or localCoords[1] < 0:
-                        continue
-                    self.image.putpixel(localCoords, color)
+        xs = np.arange(-int(self.width / 2), int(self.width / 2))
+        ys = np.arange(-int(self.height / 2), int(self.height / 2))
+        xs = xs[xs % interval[0] == 0]
+        ys = ys[ys % interval[1] == 0]
+        x, y = np.meshgrid(xs, ys)
+        px, py = self.ConvertXYArray(x.ravel(), y.ravel())
+        self.PutPixels(px, py, color)
 
     def ShowImage(self):
         self.image.show()
@@ -84,7 +174,7 @@ def WavelengthToRGB(microns):
     b = 0
     factor =1
     if wavelength >= 380 and wavelength < 440 :
-        r = -(wavelength - 400) / (440 - 380)
+        r = -(wavelength - 440) / (440 - 380)
         g = 0
         b = 1
     elif wavelength >= 440 and wavelength < 490 :
@@ -123,4 +213,67 @@ def WavelengthToRGB(microns):
     r = r * factor
     g = g * factor
     b = b * factor
-    return (int(r * 255), int(g*255), int(b*255))
\ No newline at end of file
+    return (int(r * 255), int(g*255), int(b*255))
+
+# Colors of an array of wavelengths, WavelengthToRGB is evaluated once per distinct wavelength
+def WavelengthToRGBArray(microns):
+    values, inverse = np.unique(np.asarray(microns), return_inverse=True)
+    # Components are clipped to the uint8 range before the cast
+    colors = np.clip(np.array([WavelengthToRGB(m) for m in values], dtype=np.int64).reshape(-1, 3), 0, 255).astype(np.uint8)
+    return colors[inverse.ravel()]
+
+# Distinct rows of equally long integer columns and how often each occurs
+# The columns are sorted together with lexsort, so no packed key can overflow
+def UniqueRows(columns):
+    if len(columns[0]) == 0:
+        return [c[:0] for c in columns], np.zeros(0, dtype=np.int64)
+    order = np.lexsort(columns[::-1])
+    columns = [c[order] for c in columns]
+    change = np.zeros(len(order), dtype=bool)
+    change[0] = True
+    for c in columns:
+        change[1:] |= c[1:] != c[:-1]
+    starts = np.flatnonzero(change)
+    count = np.diff(np.append(starts, len(order)))
+    return [c[starts] for c in columns], count
+
+# Clips line segments in pixel space to the [0, width) x [0, height) rectangle (Liang-Barsky)
+# Returns the clipped end points and a mask of the segments that are at least partly visible
+def ClipSegments(x0, y0, x1, y1, width, height):
+    dx = x1 - x0
+    dy = y1 - y0
+    t0 = np.zeros(len(x0))
+    t1 = np.ones(len(x0))
+    visible = np.isfinite(x0) & np.isfinite(y0) & np.isfinite(x1) & np.isfinite(y1)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        for p, q in [(-dx, x0), (dx, width - 1 - x0), (-dy, y0), (dy, height - 1 - y0)]:
+            parallel = p == 0
+            visible &= ~(parallel & (q < 0))
+            r = q / p
+            t0 = np.where(~parallel & (p < 0), np.maximum(t0, r), t0)
+            t1 = np.where(~parallel & (p > 0), np.minimum(t1, r), t1)
+    visible &= t0 <= t1
+    return x0 + t0 * dx, y0 + t0 * dy, x0 + t1 * dx, y0 + t1 * dy, visible
+
+# Rasterizes line segments given in pixel space
+# Yields pixel x, pixel y and segment index arrays holding at most maxPixels pixels (one segment may exceed it)
+def RasterizeSegments(x0, y0, x1, y1, width, height, maxPixels=2**22):
+    x0, y0, x1, y1, visible = ClipSegments(x0, y0, x1, y1, width, height)
+    seg = np.flatnonzero(visible)
+    x0, y0, x1, y1 = x0[seg], y0[seg], x1[seg], y1[seg]
+    steps = np.ceil(np.maximum(np.abs(x1 - x0), np.abs(y1 - y0))).astype(np.int64) + 1
+    ends = np.cumsum(steps)
+    start = 0
+    while start < len(seg):
+        # Segments whose pixels fit in this chunk
+        base = ends[start - 1] if start > 0 else 0
+        stop = max(start + 1, np.searchsorted(ends, base + maxPixels, side="right"))
+        n = steps[start:stop]
+        idx = np.repeat(np.arange(start, stop), n)
+        # Position of every pixel along its segment
+        k = np.arange(len(idx)) - np.repeat(ends[start:stop] - n - base, n)
+        frac = k / np.maximum(steps[idx] - 1, 1)
+        px = np.rint(x0[idx] + (x1[idx] - x0[idx]) * frac).astype(np.int64)
+        py = np.rint(y0[idx] + (y1[idx] - y0[idx]) * frac).astype(np.int64)
+        yield np.clip(px, 0, width - 1), np.clip(py, 0, height - 1), seg[idx]
+        start = stop
@@ -0,0 +1,123 @@
+import copy
+import heapq
+import multiprocessing
+
+import numpy as np
+
+# Catalog wide lens substitution
+# Every candidate part is put into one slot of a copy of the assembly and scored with a merit function,
+# such as optimizer.HitMerit, lower scores are better
+
+# Search state held by every worker process, set once by the pool initializer
+_search = None
+
+def _InitWorker(assembly, slot, merit, catalog):
+    global _search
+    _search = (assembly, slot, merit, catalog)
+
+# Scores a chunk of part numbers inside a worker, candidates with an undefined merit score inf
+def _EvaluateParts(parts):
+    assembly, slot, merit, catalog = _search
+    scores = []
+    for part in parts:
+        # A malformed part or a merit that fails on it scores inf instead of aborting the whole chunk
+        try:
+            assembly.SetLens(slot, catalog[part])
+            score = float(merit(assembly))
+        except Exception:
+            score = np.inf
+        scores.append((part, score if np.isfinite(score) else np.inf))
+    return scores
+
+# Ranks catalog parts for slot slot of assembly
+# catalog is the parsed JSON dictionary or a catalog.Catalog, the assembly itself is never modified
+# screen is an optional callable taking the assembly, e.g. paraxial.Screen, candidates it rejects are not traced
+# Only the best topK candidates are kept while results stream in from the pool
+class SlotSearch:
+    def __init__(self, assembly, slot, merit, catalog, screen=None, topK=10, processes=None, chunkSize=8):
+        self._assembly = copy.deepcopy(assembly)
+        self._slot = slot
+        self._merit = merit
+        self._catalog = catalog
+        self._screen = screen
+        self._topK = topK
+        self._processes = processes or multiprocessing.cpu_count()
+        self._chunkSize = chunkSize
+        self._heap = []
+        self._evaluated = 0
+        self._pruned = 0
+
+    # Part numbers that pass the paraxial screen, the screen costs microseconds per part so it runs in this process
+    def Screen(self, parts):
+        if self._screen is None:
+            return list(parts)
+        accepted = []
+        for part in parts:
+            # Parts that cannot be built or screened are rejected like the ones the screen fails
+            try:
+                self._assembly.SetLens(self._slot, self._catalog[part])
+                if self._screen(self._assembly):
+                    accepted.append(part)
+            except Exception:
+                continue
+        return accepted
+
+    # Yields (part, score) for every traced candidate as soon as its chunk finishes, in completion order
+    # parts defaults to every part of the catalog, e.g. pass catalog.Query("BK7") to search a subset
+    def Stream(self, parts=None):
+        if parts is None:
+            parts = list(self._catalog.keys())
+        parts = list(parts)
+        candidates = self.Screen(parts)
+        self._pruned += len(parts) - len(candidates)
+        chunks = [candidates[i:i + self._chunkSize] for i in range(0, len(candidates), self._chunkSize)]
+
+        initargs = (self._assembly, self._slot, self._merit, self._catalog)
+        if self._processes <= 1:
+            _InitWorker(*copy.deepcopy(initargs))
+            results = map(_EvaluateParts, chunks)
+            pool = None
+        else:
+            pool = multiprocessing.Pool(self._processes, initializer=_InitWorker, initargs=initargs)
+            results = pool.imap_unordered(_EvaluateParts, chunks)
+        try:
+            for scores in results:
+                for part, score in scores:
+                    self._Keep(part, score)
+                    self._evaluated += 1
+                    yield part, score
+        finally:
+            if pool is not None:
+                pool.terminate()
+                pool.join()
+
+    # Runs the whole search and returns the ranking
+    def Run(self, parts=None):
+        for part, score in self.Stream(parts):
+            pass
+        return self.ranking
+
+    # Max heap on the score holding the topK best candidates
+    def _Keep(self, part, score):
+        item = (-score, part)
+        if len(self._heap) < self._topK:
+            heapq.heappush(self._heap, item)
+        elif item > self._heap[0]:
+            heapq.heapreplace(self._heap, item)
+
+    # Best candidates so far as (score, part), best first
+    @property
+    def ranking(self):
+        return sorted((-score, part) for score, part in self._heap)
+
+    @property
+    def evaluated(self):
+        return self._evaluated
+
+    @property
+    def pruned(self):
+        return self._pruned
+
+# Convenience wrapper that runs one SlotSearch and returns its ranking
+def SearchSlot(assembly, slot, merit, catalog, parts=None, screen=None, topK=10, processes=None, chunkSize=8):
+    return SlotSearch(assembly, slot, merit, catalog, screen, topK, processes, chunkSize).Run(parts)
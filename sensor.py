@@ -0,0 +1,87 @@
+import numpy as np
+
+# Flat sensor perpendicular to the x axis at position x
+# The sensor is split into rows along y and columns along z, either by count or by pixel pitch
+# channels is an optional list of wavelengths (microns), each hit is binned into the nearest channel
+class Sensor:
+    def __init__(self, x, height, width=0, rows=1000, columns=1, pitch=None, channels=None, center=(0, 0)):
+        self._x = x
+        self._height = height
+        self._width = width
+        if pitch is not None:
+            rows = max(1, int(round(height / pitch)))
+            columns = max(1, int(round(width / pitch))) if width > 0 else 1
+        self._rows = rows
+        self._columns = columns
+        self._center = center
+        self._channels = None if channels is None else np.sort(np.asarray(channels, dtype=float))
+
+    # Sensor at the end of a lens assembly, matching LensAssembly.SensorEquation
+    @classmethod
+    def FromAssembly(cls, assembly, rows=1000, **kwargs):
+        return cls(assembly.sensorX, assembly.sensorHeight, rows=rows, **kwargs)
+
+    # Intersects every ray of a bundle with the sensor plane
+    # Returns the ray parameter, the y and z of the hit and a mask of the rays that land on the sensor
+    def Hits(self, b):
+        with np.errstate(divide="ignore", invalid="ignore"):
+            t = (self._x - b.x) / b.dx
+        y = b.y + b.dy * t
+        if hasattr(b, "z"):
+            z = b.z + b.dz * t
+        else:
+            z = np.full(len(t), self._center[1], dtype=float)
+        valid = np.isfinite(t) & (t >= 0)
+        valid &= np.abs(y - self._center[0]) <= self._height / 2
+        if self._width > 0:
+            valid &= np.abs(z - self._center[1]) <= self._width / 2
+        return t, y, z, valid
+
+    # Bins hit coordinates into a (channels, rows, columns) array of counts
+    def Histogram(self, y, z=None, microns=None, weights=None):
+        row = np.floor((y - self._center[0] + self._height / 2) * (self._rows / self._height)).astype(np.int64)
+        row = np.clip(row, 0, self._rows - 1)
+        if z is None or self._width <= 0:
+            col = np.zeros(len(row), dtype=np.int64)
+        else:
+            col = np.floor((z - self._center[1] + self._width / 2) * (self._columns / self._width)).astype(np.int64)
+            col = np.clip(col, 0, self._columns - 1)
+        if self._channels is None or microns is None:
+            channel = np.zeros(len(row), dtype=np.int64)
+        else:
+            # Nearest channel, split at the midpoints between channel wavelengths
+            channel = np.searchsorted((self._channels[1:] + self._channels[:-1]) / 2, microns)
+        flat = (channel * self._rows + row) * self._columns + col
+        size = self.numChannels * self._rows * self._columns
+        counts = np.bincount(flat, weights=weights, minlength=size)
+        return counts.reshape(self.numChannels, self._rows, self._columns)
+
+    # Histogram of the rays of a bundle that hit the sensor
+    def HitHistogram(self, b):
+        t, y, z, valid = self.Hits(b)
+        microns = np.broadcast_to(b.microns, len(t))[valid]
+        return self.Histogram(y[valid], z[valid], microns)
+
+    # Hits per row summed over channels and columns, same layout as optimizer.CalculateHits
+    def Profile(self, b):
+        return self.HitHistogram(b).sum(axis=(0, 2))
+
+    @property
+    def x(self):
+        return self._x
+
+    @property
+    def rows(self):
+        return self._rows
+
+    @property
+    def columns(self):
+        return self._columns
+
+    @property
+    def numChannels(self):
+        return 1 if self._channels is None else len(self._channels)
+
+    @property
+    def channels(self):
+        return self._channels
@@ -0,0 +1,107 @@
+import numpy as np
+
+import ior
+import lens
+
+# Flat table of every refracting surface of a lens assembly, front to back
+# Row s is surface s + 1 of a trace, its refracted rays are stored at index s + 1 of a TraceResult
+# Per surface the table holds the vertex, radius, curvature, conic, asphere coefficients zero padded to a
+# common length, sag clamp, aperture radius, material before and after and bounding slab
+# Built by LensAssembly.surfaces, so cemented groups and single lenses trace through the same loop
+class SurfaceTable:
+    def __init__(self, lenses, samples=257, margin=1e-3):
+        surfaces = []
+        apertures = []
+        self._before = []
+        self._after = []
+        for l in lenses:
+            # Air on both sides of every lens, the elements of a cemented group in between
+            media = ["Air"] + list(l.media) + ["Air"]
+            for i, surface in enumerate(l.surfaces):
+                surfaces.append(surface)
+                apertures.append(l.config["diameter"] / 2)
+                self._before.append(media[i])
+                self._after.append(media[i + 1])
+
+        columns = np.array([s[:4] for s in surfaces], dtype=float).reshape(-1, 4)
+        self._vertexX, self._vertexY, self._radius, self._conic = columns.T
+        with np.errstate(divide="ignore"):
+            self._curvature = np.where(self._radius == 0, 0.0, 1.0 / self._radius)
+        self._clamp = np.array([s[5] for s in surfaces], dtype=float)
+        self._numCoeff = np.array([len(s[4]) for s in surfaces], dtype=int)
+        self._coeff = np.zeros((len(surfaces), max(self._numCoeff, default=0)))
+        for i, s in enumerate(surfaces):
+            self._coeff[i, :self._numCoeff[i]] = s[4]
+        self._apertures = np.array(apertures, dtype=float)
+        self._slabs = np.array([lens.SurfaceBounds(self.Surface(i), self._apertures[i], samples, margin)
+                                for i in range(len(surfaces))], dtype=float).reshape(-1, 4)
+
+    def __len__(self):
+        return len(self._vertexX)
+
+    # Row i in the Lens.frontSurface form taken by raytracer.RefractBundle, built from the columns
+    def Surface(self, i):
+        return (self._vertexX[i], self._vertexY[i], self._radius[i], self._conic[i],
+                self._coeff[i, :self._numCoeff[i]], self._clamp[i])
+
+    # Refractive index before and after every surface, as two lists
+    # microns is a scalar or a per ray array, every material is evaluated once
+    def Indices(self, microns):
+        indices = {}
+        for material in self._before + self._after:
+            if material not in indices:
+                indices[material] = ior.GetIOR(microns, material)
+        return [indices[m] for m in self._before], [indices[m] for m in self._after]
+
+    @property
+    def vertexX(self):
+        return self._vertexX
+
+    @property
+    def vertexY(self):
+        return self._vertexY
+
+    @property
+    def radius(self):
+        return self._radius
+
+    # 1 / radius, zero for flat surfaces
+    @property
+    def curvature(self):
+        return self._curvature
+
+    @property
+    def conic(self):
+        return self._conic
+
+    # (surfaces, most coefficients) array, shorter lists are padded with zeros
+    @property
+    def coeff(self):
+        return self._coeff
+
+    # Number of coefficients of every surface before the padding
+    @property
+    def numCoeff(self):
+        return self._numCoeff
+
+    @property
+    def clamp(self):
+        return self._clamp
+
+    @property
+    def apertures(self):
+        return self._apertures
+
+    # Material names before and after every surface
+    @property
+    def before(self):
+        return self._before
+
+    @property
+    def after(self):
+        return self._after
+
+    # Bounding slab of every surface as a (surfaces, 4) array of xmin, xmax, ymin, ymax
+    @property
+    def slabs(self):
+        return self._slabs
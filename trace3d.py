@@ -0,0 +1,39 @@
+import numpy as np
+
+import raytracer
+
+# 3D trace mode for skew rays through rotationally symmetric surfaces
+# Every surface of the assembly surface table is revolved around the x axis through its vertex, so the sag of
+# Lens.Surface becomes a function of the radial distance h = sqrt(y^2 + z^2) and the same conic and
+# asphere parameters describe it
+# Intersection, refraction and tracing are shared with the 2D tracer, which runs meridional rays with z = dz = 0
+# Rays are ray.RayBundle3D, e.g. from emitter.Emitter3D, and the final rays go to a sensor.Sensor with a width
+
+# Calculates the intersection of many skew rays with a rotationally symmetric surface at once
+# Input: arrays of ray origins (x, y, z) and unit directions (dx, dy, dz), surface tuple from the surface table
+# Returns ray parameter t, the local y and z of the hit and a validity mask
+# diagnostics=True also returns the residual and the number of iterations of every ray
+def IntersectSurface3D(x, y, z, dx, dy, dz, surface, maxIter=20, tol=1e-9, diagnostics=False, aperture=np.inf):
+    t, hy, hz, valid, residual, iters = raytracer.IntersectRevolved(x, y, z, dx, dy, dz, surface, maxIter, tol,
+                                                                    aperture=aperture)
+    if diagnostics:
+        return t, hy, hz, valid, residual, iters
+    return t, hy, hz, valid
+
+# Traces every 3D emitter through the lens assembly, raytracer.RayTrace with skew rays
+# keepSegments=False only stores the rays leaving the final surface
+# Returns a traceresult.TraceResult holding ray.RayBundle3D segments
+def RayTrace3D(lights, assembly, keepSegments=True, stats=False):
+    return raytracer.RayTrace(lights, assembly, keepSegments, stats=stats)
+
+# Spot diagram of the live rays of a bundle on the plane at x
+# Returns the y and z of every hit and the RMS radius around their centroid
+def SpotDiagram(b, x):
+    live = b.alive & (b.dx != 0)
+    t = (x - b.x[live]) / b.dx[live]
+    y = b.y[live] + b.dy[live] * t
+    z = b.z[live] + b.dz[live] * t
+    if len(y) == 0:
+        return y, z, np.nan
+    rms = np.sqrt(np.mean((y - y.mean()) ** 2 + (z - z.mean()) ** 2))
+    return y, z, rms
@@ -0,0 +1,94 @@
+import numpy as np
+import ray
+import tracestats
+
+# Preallocated storage for the ray segments that start at one surface
+# Grows by doubling when the capacity is exceeded so appends stay linear
+# bundleType is ray.RayBundle or ray.RayBundle3D, its FIELDS are the columns of the table
+class SegmentTable:
+    def __init__(self, capacity=0, bundleType=ray.RayBundle):
+        self._size = 0
+        self._bundleType = bundleType
+        self._arrays = {}
+        for name, dtype in zip(bundleType.FIELDS, bundleType.DTYPES):
+            self._arrays[name] = np.empty(max(capacity, 1), dtype=dtype)
+
+    def Reserve(self, capacity):
+        if capacity <= len(self._arrays["x"]):
+            return
+        capacity = max(capacity, 2 * len(self._arrays["x"]))
+        for name in self._bundleType.FIELDS:
+            old = self._arrays[name]
+            self._arrays[name] = np.empty(capacity, dtype=old.dtype)
+            self._arrays[name][:self._size] = old[:self._size]
+
+    # Copies the rays of a bundle into the table
+    def Append(self, b):
+        n = len(b)
+        self.Reserve(self._size + n)
+        for name in self._bundleType.FIELDS:
+            self._arrays[name][self._size:self._size + n] = getattr(b, name)
+        self._size += n
+
+    # Returns the stored rays as a RayBundle
+    def Bundle(self):
+        a = [self._arrays[name][:self._size] for name in self._bundleType.FIELDS]
+        return self._bundleType(*a)
+
+    def __len__(self):
+        return self._size
+
+
+# Result of a RayTrace
+# Table 0 holds the emitted rays, table i the rays leaving surface i
+# The last table holds the rays that went through the final surface
+# stats is the tracestats.TraceStats filled while tracing, a disabled one when instrumentation is off
+# bundleType is the ray.RayBundle class stored, ray.RayBundle3D for trace3d
+class TraceResult:
+    def __init__(self, numSurfaces, capacity=0, keepSegments=True, stats=None, bundleType=ray.RayBundle):
+        self._keepSegments = keepSegments
+        self._bundleType = bundleType
+        self._stats = tracestats.DISABLED if stats is None else stats
+        self._tables = []
+        for i in range(numSurfaces + 1):
+            if keepSegments or i == numSurfaces:
+                self._tables.append(SegmentTable(capacity, bundleType))
+            else:
+                self._tables.append(None)
+
+    # Stores the segments starting at surface idx, ignored for intermediate surfaces when keepSegments is off
+    def Store(self, idx, b):
+        if self._tables[idx] is not None:
+            self._tables[idx].Append(b)
+
+    # Rays starting at surface idx
+    def Segments(self, idx):
+        if self._tables[idx] is None:
+            raise Exception("segments of surface {} were not kept".format(idx))
+        return self._tables[idx].Bundle()
+
+    # Every stored segment as a single bundle
+    @property
+    def rays(self):
+        return self._bundleType.Concatenate([t.Bundle() for t in self._tables if t is not None])
+
+    @property
+    def finalrays(self):
+        return self._tables[-1].Bundle()
+
+    @property
+    def numSurfaces(self):
+        return len(self._tables) - 1
+
+    @property
+    def keepSegments(self):
+        return self._keepSegments
+
+    @property
+    def stats(self):
+        return self._stats
+
+    # Allows rays, finalrays = RayTrace(...)
+    def __iter__(self):
+        yield self.rays
+        yield self.finalrays
@@ -0,0 +1,107 @@
+import time
+from contextlib import nullcontext
+
+# Opt in instrumentation of traces
+# Stages are timed with TraceStats.Timer, per surface counters are added with TraceStats.Count
+# A disabled TraceStats hands out a shared empty context and ignores counts, so the hooks cost a few
+# attribute lookups per bundle and nothing per ray
+
+# Counters kept for every surface
+#   rays        alive rays arriving at the surface
+#   culled      rays rejected by the bounding slab before root finding
+#   failed      rays the intersection solver found no hit for
+#   vignetted   hits outside the aperture
+#   tir         rays lost to total internal reflection
+#   refracted   rays leaving the surface
+#   iterations  solver iterations summed over the rays
+COUNTERS = ["rays", "culled", "failed", "vignetted", "tir", "refracted", "iterations"]
+
+_null = nullcontext()
+
+class _Timer:
+    __slots__ = ["_stats", "_stage", "_start"]
+
+    def __init__(self, stats, stage):
+        self._stats = stats
+        self._stage = stage
+
+    def __enter__(self):
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, *args):
+        self._stats.AddTime(self._stage, time.perf_counter() - self._start)
+
+class TraceStats:
+    def __init__(self, enabled=True):
+        self._enabled = enabled
+        self._times = {}
+        self._surfaces = {}
+
+    # Context manager adding the wall time of its block to stage
+    def Timer(self, stage):
+        if not self._enabled:
+            return _null
+        return _Timer(self, stage)
+
+    def AddTime(self, stage, seconds, calls=1):
+        if not self._enabled:
+            return
+        entry = self._times.setdefault(stage, [0.0, 0])
+        entry[0] += seconds
+        entry[1] += calls
+
+    def Count(self, surface, counter, n):
+        if not self._enabled:
+            return
+        counters = self._surfaces.get(surface)
+        if counters is None:
+            counters = self._surfaces[surface] = dict.fromkeys(COUNTERS, 0)
+        counters[counter] += int(n)
+
+    # Adds the times and counters of another TraceStats, e.g. one returned by a worker process
+    def Merge(self, other):
+        if not self._enabled:
+            return
+        for stage, (seconds, calls) in other._times.items():
+            self.AddTime(stage, seconds, calls)
+        for surface, counters in other._surfaces.items():
+            for counter, n in counters.items():
+                self.Count(surface, counter, n)
+
+    def Clear(self):
+        self._times.clear()
+        self._surfaces.clear()
+
+    @property
+    def enabled(self):
+        return self._enabled
+
+    # {stage: {"time": seconds, "calls": calls}}
+    @property
+    def stages(self):
+        return {stage: {"time": seconds, "calls": calls} for stage, (seconds, calls) in self._times.items()}
+
+    # {surface index: {counter: value}}, surfaces are numbered 1..N like the TraceResult indices of their refracted rays
+    @property
+    def surfaces(self):
+        return {surface: dict(self._surfaces[surface]) for surface in sorted(self._surfaces)}
+
+    def AsDict(self):
+        return {"stages": self.stages, "surfaces": self.surfaces}
+
+    # Readable tables of the stages, slowest first, and the surface counters
+    def Report(self):
+        lines = ["{:<14}{:>12}{:>10}".format("stage", "seconds", "calls")]
+        for stage, (seconds, calls) in sorted(self._times.items(), key=lambda item: -item[1][0]):
+            lines.append("{:<14}{:>12.6f}{:>10}".format(stage, seconds, calls))
+        lines.append("{:<8}".format("surface") + "".join("{:>12}".format(c) for c in COUNTERS))
+        for surface, counters in self.surfaces.items():
+            lines.append("{:<8}".format(surface) + "".join("{:>12}".format(counters[c]) for c in COUNTERS))
+        return "\n".join(lines)
+
+    def __str__(self):
+        return self.Report()
+
+# Shared instance used when instrumentation is off
+DISABLED = TraceStats(enabled=False)